@@ -0,0 +1,238 @@
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.dateparse import parse_datetime
+import datetime
+import json
+import os
+import shutil
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def archive_dir():
+    """Directory holding the columnar archives of finished sessions. Set with
+    ``REDWOOD_ARCHIVE_DIR`` in settings.py.
+    """
+    default = os.path.join(getattr(settings, 'BASE_DIR', os.getcwd()), 'redwood_archive')
+    return getattr(settings, 'REDWOOD_ARCHIVE_DIR', default)
+
+
+def require_numpy():
+    if np is None:
+        raise ImproperlyConfigured('numpy is required for this: pip install otree-redwood[numpy]')
+
+
+def to_micros(timestamp):
+    return (timestamp - EPOCH) // MICROSECOND
+
+
+def from_micros(micros):
+    return EPOCH + datetime.timedelta(microseconds=int(micros))
+
+
+def session_path(session_code):
+    return os.path.join(archive_dir(), session_code)
+
+
+def group_path(session_code, app_name, group_pk):
+    return os.path.join(session_path(session_code), app_name, str(group_pk))
+
+
+def read_manifest(session_code):
+    """Returns the manifest of the session's archive, or None if it hasn't been archived.
+
+    The manifest is ``{'session': code, 'apps': {app_name: {group_pk: entry}}}``, where
+    each entry has the group's archived ``count``, ``first_id``, ``last_id`` and
+    ``last_timestamp``, and ``deleted``, which is True once the archived rows are gone
+    from the Event table.
+    """
+    try:
+        with open(os.path.join(session_path(session_code), 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(session_code, manifest):
+    path = os.path.join(session_path(session_code), 'manifest.json')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def write_group(session_code, app_name, group_pk, events):
+    """Writes the group's Events, in order, as one ``.npy`` file per column and
+    returns the group's manifest entry. Columns:
+
+    ``id``, ``timestamp`` (int64 microseconds since the epoch), ``participant`` and
+    ``channel`` (int32 indexes into the lists in ``meta.json``; -1 for no
+    participant), ``value_offsets`` (int64) and ``values`` (uint8), the UTF-8 JSON of
+    each value concatenated, and ``value_number`` (float64), the value where it is a
+    number and NaN elsewhere.
+    """
+    require_numpy()
+    ids, timestamps, participant_column, channel_column, offsets, numbers = [], [], [], [], [0], []
+    participants, channels = {}, {}
+    values = bytearray()
+    for event in events:
+        ids.append(event.id)
+        timestamps.append(to_micros(event.timestamp))
+        if event.participant_id is None:
+            participant_column.append(-1)
+        else:
+            participant = (event.participant_id, event.participant.code)
+            participant_column.append(participants.setdefault(participant, len(participants)))
+        channel_column.append(channels.setdefault(event.channel, len(channels)))
+        values += json.dumps(event.value).encode('utf-8')
+        offsets.append(len(values))
+        is_number = isinstance(event.value, (int, float)) and not isinstance(event.value, bool)
+        numbers.append(event.value if is_number else np.nan)
+
+    path = group_path(session_code, app_name, group_pk)
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name, array in [
+            ('id', np.array(ids, dtype=np.int64)),
+            ('timestamp', np.array(timestamps, dtype=np.int64)),
+            ('participant', np.array(participant_column, dtype=np.int32)),
+            ('channel', np.array(channel_column, dtype=np.int32)),
+            ('value_offsets', np.array(offsets, dtype=np.int64)),
+            ('values', np.frombuffer(bytes(values), dtype=np.uint8)),
+            ('value_number', np.array(numbers, dtype=np.float64))]:
+        np.save(os.path.join(tmp, name + '.npy'), array)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump({
+            'participants': [[pk, code] for pk, code in participants],
+            'channels': list(channels),
+        }, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    return {
+        'count': len(ids),
+        'first_id': min(ids) if ids else None,
+        'last_id': max(ids) if ids else None,
+        'last_timestamp': from_micros(max(timestamps)).isoformat() if timestamps else None,
+        'deleted': False,
+    }
+
+
+class GroupArchive():
+    """The archived Events of one group, with every column memory-mapped."""
+
+    def __init__(self, path):
+        require_numpy()
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.participants = [tuple(p) for p in meta['participants']]
+        self.channels = meta['channels']
+        for name in ['id', 'timestamp', 'participant', 'channel', 'value_offsets', 'values', 'value_number']:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.id)
+
+    def value(self, i):
+        return json.loads(bytes(self.values[self.value_offsets[i]:self.value_offsets[i + 1]]).decode('utf-8'))
+
+    def mask(self, group_pk, channels=None, participant_code=None, start=None, end=None,
+             since=None, until=None, after=None):
+        """Boolean array selecting the Events that match the filters of
+        :func:`otree_redwood.export.group_events`.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if channels:
+            mask &= np.isin(self.channel, [i for i, c in enumerate(self.channels) if c in channels])
+        if participant_code is not None:
+            mask &= np.isin(self.participant, [i for i, (_, code) in enumerate(self.participants) if code == participant_code])
+        if start is not None:
+            mask &= self.timestamp >= to_micros(start)
+        if end is not None:
+            mask &= self.timestamp < to_micros(end)
+        if since is not None:
+            mask &= self.id > since
+        if until is not None:
+            mask &= self.id <= until
+        if after is not None and after[0] == group_pk:
+            after_micros = to_micros(after[1])
+            mask &= (self.timestamp > after_micros) | ((self.timestamp == after_micros) & (self.id > after[2]))
+        return mask
+
+    def events(self, content_type, group_pk, **filters):
+        """Yields the matching archived Events as unsaved Event instances."""
+        from otree.models.participant import Participant
+        from otree_redwood.models import Event
+        participants = [Participant(id=pk, code=code) for pk, code in self.participants]
+        for i in np.flatnonzero(self.mask(group_pk, **filters)):
+            event = Event(
+                id=int(self.id[i]),
+                timestamp=from_micros(self.timestamp[i]),
+                content_type=content_type,
+                group_pk=group_pk,
+                channel=self.channels[self.channel[i]],
+                value=self.value(i))
+            if self.participant[i] >= 0:
+                event.participant = participants[self.participant[i]]
+            yield event
+
+
+def load_group(session_code, app_name, group_pk):
+    """Returns the GroupArchive of a group, for analysis."""
+    return GroupArchive(group_path(session_code, app_name, group_pk))
+
+
+def _deleted_entries(groups, group_pk=None, after=None):
+    """Yields ``(session_code, pk, entry)`` for each group in the queryset, in pk
+    order, whose archived rows have been deleted from the Event table.
+    """
+    if np is None or not os.path.isdir(archive_dir()):
+        return
+    app_name = groups.model._meta.app_label
+    manifests = {}
+    for pk, session_code in groups.order_by('pk').values_list('pk', 'session__code'):
+        if group_pk is not None and pk != group_pk:
+            continue
+        if after is not None and pk < after[0]:
+            continue
+        if session_code not in manifests:
+            manifests[session_code] = read_manifest(session_code)
+        manifest = manifests[session_code]
+        entry = manifest and manifest['apps'].get(app_name, {}).get(str(pk))
+        if entry and entry['deleted']:
+            yield session_code, pk, entry
+
+
+def events(groups, group_pk=None, after=None, **filters):
+    """Yields the archived Events of the groups in the queryset whose rows have been
+    deleted from the Event table, in the order of :func:`otree_redwood.export.group_events`.
+    """
+    content_type = ContentType.objects.get_for_model(groups.model)
+    app_name = groups.model._meta.app_label
+    for session_code, pk, entry in _deleted_entries(groups, group_pk, after):
+        group = load_group(session_code, app_name, pk)
+        yield from group.events(content_type, pk, after=after, **filters)
+
+
+def last_event(groups):
+    """Returns ``{'id': ..., 'timestamp': ...}`` of the latest archived Event of the
+    groups in the queryset whose rows have been deleted.
+    """
+    latest = {'id': None, 'timestamp': None}
+    for _, _, entry in _deleted_entries(groups):
+        if entry['last_id'] is None:
+            continue
+        timestamp = parse_datetime(entry['last_timestamp'])
+        if latest['id'] is None or entry['last_id'] > latest['id']:
+            latest['id'] = entry['last_id']
+        if latest['timestamp'] is None or timestamp > latest['timestamp']:
+            latest['timestamp'] = timestamp
+    return latest
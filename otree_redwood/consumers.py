@@ -1,22 +1,206 @@
-from channels.generic.websocket import JsonWebsocketConsumer
-from channels.layers import get_channel_layer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer, JsonWebsocketConsumer
 from asgiref.sync import async_to_sync
-from django.db.models.signals import post_save
-import django.dispatch
+from collections import deque
+from django.conf import settings
+import asyncio
+import functools
 import importlib
-import json
 from otree.models.participant import Participant
 
-from otree_redwood.models import Event, Connection
-from otree_redwood import stats
+from otree_redwood.models import Event, group_generation
+from otree_redwood import presence, stats, watchers, writer
+from otree_redwood.wire import CodecMixin
+
+
+@functools.lru_cache(maxsize=None)
+def get_group_model(app_name):
+    """Returns the Group model class of the given app."""
+    models_module = importlib.import_module('{}.models'.format(app_name))
+    return models_module.Group
 
 
 def get_group(app_name, group_pk):
     with stats.track('fetch group') as obs:
-        models_module = importlib.import_module('{}.models'.format(app_name))
-        return models_module.Group.objects.get(pk=group_pk)
+        return get_group_model(app_name).objects.get(pk=group_pk)
+
+
+def outbound_queue_size():
+    """Maximum number of group messages waiting to be sent to one socket.
+    Set with ``REDWOOD_OUTBOUND_QUEUE_SIZE`` in settings.py.
+    """
+    return getattr(settings, 'REDWOOD_OUTBOUND_QUEUE_SIZE', 256)
+
+
+def outbound_window():
+    """Maximum number of frames sent to one socket and not yet acknowledged by the
+    client; further group messages wait in its :class:`OutboundQueue`. Must be more
+    than the 8 frames ``<redwood-events>`` receives between acknowledgements.
+    Set with ``REDWOOD_OUTBOUND_WINDOW`` in settings.py.
+    """
+    return getattr(settings, 'REDWOOD_OUTBOUND_WINDOW', 32)
+
+
+def coalesced_channels():
+    """Channels whose messages carry the whole current state, so a queued message is
+    superseded by a newer one. Set with ``REDWOOD_COALESCED_CHANNELS`` in settings.py.
+    """
+    return set(getattr(settings, 'REDWOOD_COALESCED_CHANNELS', ['group_decisions']))
+
+
+class OutboundQueue():
+    """Bounded queue of messages waiting to be sent to one socket. A message on a
+    coalesced channel takes the place of the queued messages it supersedes: a full
+    snapshot replaces the first queued message on its channel and removes the rest, and
+    a delta (see :meth:`otree_redwood.models.DecisionGroup.delta_broadcasts`) is merged
+    into a queued snapshot where it stands. A steady stream of updates therefore
+    doesn't keep pushing the latest state to the back of the queue. When the queue is
+    full the oldest message not on the ``state`` channel is dropped, so a slow client
+    falls behind on intermediate updates only.
+    """
+
+    def __init__(self, maxsize, coalesced):
+        self.maxsize = maxsize
+        self.coalesced = coalesced
+        self.messages = deque()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, content):
+        if content.get('channel') in self.coalesced:
+            coalesced = self._coalesce(content)
+            if coalesced:
+                stats.increment('outbound frames coalesced', coalesced)
+                return
+        if len(self.messages) >= self.maxsize:
+            self._drop()
+            stats.increment('outbound frames dropped')
+        self.messages.append(content)
+
+    def get(self):
+        return self.messages.popleft()
+
+    def _coalesce(self, content):
+        """Puts the content in place of the queued messages it supersedes. Returns the
+        number of messages superseded; if none, the content still has to be queued.
+        """
+        channel = content['channel']
+        if not content.get('delta'):
+            indexes = [i for i, m in enumerate(self.messages) if m.get('channel') == channel]
+            if indexes:
+                self.messages[indexes[0]] = content
+                for i in reversed(indexes[1:]):
+                    del self.messages[i]
+            return len(indexes)
+        for i in range(len(self.messages) - 1, -1, -1):
+            queued = self.messages[i]
+            if queued.get('channel') != channel:
+                continue
+            if queued.get('delta'):
+                # Deltas apply to consecutive versions, so they can't be merged.
+                return 0
+            # Messages may be shared with other consumers, so merge into a copy.
+            payload = dict(queued['payload'])
+            payload.update(content['payload'])
+            merged = dict(queued, payload=payload)
+            if 'version' in content:
+                merged['version'] = content['version']
+            self.messages[i] = merged
+            return 1
+        return 0
+
+    def _drop(self):
+        for i, message in enumerate(self.messages):
+            if message.get('channel') != 'state':
+                del self.messages[i]
+                return
+        self.messages.popleft()
+
+
+class OutboundWindowMixin():
+    """Holds back group messages while a client falls behind. ``<redwood-events>``
+    acknowledges the frames it has handled on the ``ack`` channel; once it has, at most
+    :func:`outbound_window` frames are in flight and later group messages wait in a
+    bounded, coalescing :class:`OutboundQueue` until acknowledgements arrive. The
+    client's own pace is all this relies on, so it works behind any ASGI server.
+    Clients that never acknowledge are sent every message at once, as before.
+    """
+
+    def open_outbound(self):
+        self.outbound = OutboundQueue(outbound_queue_size(), coalesced_channels())
+        self.frames_sent = 0
+        self.frames_acked = None
+
+    def count_frame(self, content):
+        """Counts a frame sent to the client; the client doesn't count pings."""
+        if content.get('channel') != 'ping':
+            self.frames_sent += 1
+
+    def receive_ack(self, content):
+        """Records the number of frames the client has handled so far."""
+        self.frames_acked = max(self.frames_acked or 0, int(content['payload']))
+
+    def next_outbound(self):
+        """Returns the next queued group message that may be sent now, or None."""
+        if not self.outbound:
+            return None
+        if self.frames_acked is not None and self.frames_sent - self.frames_acked >= outbound_window():
+            return None
+        return self.outbound.get()
+
+
+class ConnectionCacheMixin():
+    """Keeps the Group and Participant for a WebSocket connection so the steady-state
+    message path doesn't query for them. The participant is fixed for the life of the
+    socket.
 
-class EventConsumer(JsonWebsocketConsumer):
+    The group is only kept between messages when :meth:`otree_redwood.models.Group.cacheable`
+    says so, i.e. when its mutable state lives in process memory and all of its players
+    are connected to this process. Saves are only seen within this process, so otherwise
+    the group is fetched on every message. A kept group is fetched again after another
+    instance of it is saved in this process (see
+    :meth:`otree_redwood.models.Group.invalidate_cached`) or after
+    :meth:`invalidate_group` is called.
+    """
+
+    group = None
+    participant = None
+
+    def _cached_group(self):
+        """Returns the cached group, or None if it needs to be fetched."""
+        group = self.group
+        if group is not None and group.cacheable() and \
+                group.cached_generation == group_generation(type(group), group.pk):
+            stats.increment('fetch group cache hits')
+            return group
+        return None
+
+    def _fetch_group(self):
+        stats.increment('fetch group cache misses')
+        model = get_group_model(self.url_params['app_name'])
+        generation = group_generation(model, int(self.url_params['group']))
+        self.group = get_group(self.url_params['app_name'], self.url_params['group'])
+        self.group.cached_generation = generation
+        return self.group
+
+    def get_group(self):
+        return self._cached_group() or self._fetch_group()
+
+    def get_participant(self):
+        if self.participant is None:
+            self.participant = Participant.objects.get(code=self.url_params['participant_code'])
+        return self.participant
+
+    def invalidate_group(self):
+        """Forces the group to be fetched again on the next message."""
+        self.group = None
+
+    def invalidate_participant(self):
+        """Forces the participant to be fetched again on the next message."""
+        self.participant = None
+
+class EventConsumer(CodecMixin, ConnectionCacheMixin, OutboundWindowMixin, JsonWebsocketConsumer):
     
     url_pattern = (
         r'^redwood' +
@@ -26,16 +210,17 @@ class EventConsumer(JsonWebsocketConsumer):
         '/$')
 
     def connect(self):
-        self.accept()
+        self.accept(self.negotiate_codec())
         self.url_params = self.scope['url_route']['kwargs']
+        self.open_outbound()
 
-        group = get_group(self.url_params['app_name'], self.url_params['group'])
+        group = self.get_group()
         async_to_sync(self.channel_layer.group_add)(
             str(group.pk),
             self.channel_name
         )
 
-        participant = Participant.objects.get(code=self.url_params['participant_code'])
+        participant = self.get_participant()
         try:
             last_state = group.events.filter(channel='state').latest('timestamp')
             self.send_json({
@@ -44,25 +229,34 @@ class EventConsumer(JsonWebsocketConsumer):
             })
         except Event.DoesNotExist:
             pass
-        Connection.objects.get_or_create(participant=participant)
+        presence.connect(group, participant)
         group._on_connect(participant)
 
     def disconnect(self, close_code):
-        group = get_group(self.url_params['app_name'], self.url_params['group'])
+        writer.flush()
+        group = self.get_group()
         async_to_sync(self.channel_layer.group_discard)(
             str(group.pk),
             self.channel_name
         )
 
-        participant = Participant.objects.get(code=self.url_params['participant_code'])
-        try:
-            # TODO: Clean out stale connections if not terminated cleanly.
-            Connection.objects.get(participant=participant).delete()
-        except Connection.DoesNotExist:
-            pass
+        participant = self.get_participant()
+        presence.disconnect(group, participant)
         group._on_disconnect(participant)
 
+    def receive(self, text_data=None, bytes_data=None, **kwargs):
+        self.receive_json(self.decode_frame(text_data, bytes_data), **kwargs)
+
+    def send_json(self, content, close=False):
+        self.count_frame(content)
+        self.send(close=close, **self.encode_frame(content))
+
     def receive_json(self, content):
+        if content['channel'] == 'ack':
+            self.receive_ack(content)
+            self.send_outbound()
+            return
+
         if content['channel'] == 'ping':
             with stats.track('recv_channel=ping'):
                 if content['avg_ping_time']:
@@ -73,14 +267,22 @@ class EventConsumer(JsonWebsocketConsumer):
                 })
                 return
 
+        if content['channel'] == 'heartbeat':
+            with stats.track('recv_channel=heartbeat'):
+                presence.heartbeat(self.get_group(), self.get_participant())
+                return
+
         with stats.track('recv_channel=' + content['channel']):
-            group = get_group(self.url_params['app_name'], self.url_params['group'])
-            participant = Participant.objects.get(code=self.url_params['participant_code'])
+            group = self.get_group()
+            participant = self.get_participant()
+            presence.heartbeat(group, participant)
             with stats.track('saving event object to database'):
-                event = group.events.create(
+                event = Event(
+                    group=group,
                     participant=participant,
                     channel=content['channel'],
                     value=content['payload'])
+                writer.write(event)
 
             with stats.track('handing event to group'):
                 try:
@@ -91,41 +293,189 @@ class EventConsumer(JsonWebsocketConsumer):
                     event_handler(event)
     
     def redwood_send_to_group(self, event):
-        msg = event['text']
-        self.send_json(msg)
+        self.outbound.put(event['text'])
+        self.send_outbound()
+        if self.outbound:
+            stats.increment('outbound frames held back')
+
+    def send_outbound(self):
+        msg = self.next_outbound()
+        while msg is not None:
+            self.send_json(msg)
+            msg = self.next_outbound()
 
 
-class EventWatcher(JsonWebsocketConsumer):
+class EventWatcher(CodecMixin, JsonWebsocketConsumer):
 
     url_pattern = r'^redwood/events/session/(?P<session_code>[a-zA-Z0-9_-]+)/$'
 
     def connect(self):
         self.session_code = self.scope['url_route']['kwargs']['session_code']
-        self.events_group_name = 'redwood_events-{}'.format(self.session_code)
+        self.events_group_name = watchers.group_name(self.session_code)
         async_to_sync(self.channel_layer.group_add)(
             self.events_group_name,
             self.channel_name
         )
-        self.accept()
+        watchers.subscribe(self.session_code)
+        self.accept(self.negotiate_codec())
 
     def disconnect(self, close_code):
+        watchers.unsubscribe(self.session_code)
         async_to_sync(self.channel_layer.group_discard)(
             self.events_group_name,
             self.channel_name
         )
 
+    def send_json(self, content, close=False):
+        self.send(close=close, **self.encode_frame(content))
+
     def redwood_send_to_watcher(self, event):
         msg = event['text']
         self.send_json(msg)
 
 
-@django.dispatch.receiver(post_save, sender=Event)
-def on_event_save(sender, instance, **kwargs):
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        'redwood_events-{}'.format(instance.group.session.code),
-        {
-            'type': 'redwood.send_to_watcher',
-            'text': json.dumps(instance.message)
-        }
-    )
+class AsyncEventConsumer(CodecMixin, ConnectionCacheMixin, OutboundWindowMixin, AsyncJsonWebsocketConsumer):
+    """Asynchronous version of :class:`EventConsumer`. Idle sockets don't hold a
+    worker thread; database work runs in ``database_sync_to_async``, and group
+    event handlers may be coroutines (see :meth:`otree_redwood.models.Group.send_async`).
+    Enable with ``REDWOOD_ASYNC_CONSUMERS = True`` in settings.py.
+    """
+
+    url_pattern = EventConsumer.url_pattern
+
+    async def connect(self):
+        await self.accept(self.negotiate_codec())
+        self.url_params = self.scope['url_route']['kwargs']
+        self.open_outbound()
+
+        group = await database_sync_to_async(self.get_group)()
+        await self.channel_layer.group_add(
+            str(group.pk),
+            self.channel_name
+        )
+
+        last_state = await self._connect_participant(group)
+        if last_state is not None:
+            await self.send_json({
+                'channel': 'state',
+                'payload': last_state.value
+            })
+        await database_sync_to_async(group._on_connect)(self.participant)
+
+    @database_sync_to_async
+    def _connect_participant(self, group):
+        presence.connect(group, self.get_participant())
+        try:
+            return group.events.filter(channel='state').latest('timestamp')
+        except Event.DoesNotExist:
+            return None
+
+    async def disconnect(self, close_code):
+        await database_sync_to_async(writer.flush)()
+        group = self._cached_group() or await database_sync_to_async(self._fetch_group)()
+        await self.channel_layer.group_discard(
+            str(group.pk),
+            self.channel_name
+        )
+        await database_sync_to_async(self._disconnect_participant)(group)
+
+    def _disconnect_participant(self, group):
+        participant = self.get_participant()
+        presence.disconnect(group, participant)
+        group._on_disconnect(participant)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        await self.receive_json(self.decode_frame(text_data, bytes_data), **kwargs)
+
+    async def send_json(self, content, close=False):
+        self.count_frame(content)
+        await self.send(close=close, **self.encode_frame(content))
+
+    async def receive_json(self, content):
+        if content['channel'] == 'ack':
+            self.receive_ack(content)
+            await self.send_outbound()
+            return
+
+        if content['channel'] == 'ping':
+            with stats.track('recv_channel=ping'):
+                if content['avg_ping_time']:
+                    stats.update('avg_ping_time', content['avg_ping_time'])
+                await self.send_json({
+                    'channel': 'ping',
+                    'timestamp': content['timestamp'],
+                })
+                return
+
+        if content['channel'] == 'heartbeat':
+            with stats.track('recv_channel=heartbeat'):
+                group = self._cached_group() or await database_sync_to_async(self._fetch_group)()
+                await database_sync_to_async(presence.heartbeat)(group, self.get_participant())
+                return
+
+        with stats.track('recv_channel=' + content['channel']):
+            group = self._cached_group() or await database_sync_to_async(self._fetch_group)()
+            event = await self._save_event(group, content)
+
+            with stats.track('handing event to group'):
+                event_handler = getattr(group, '_on_{}_event'.format(content['channel']), None)
+                if event_handler is None:
+                    return
+                if asyncio.iscoroutinefunction(event_handler):
+                    await event_handler(event)
+                else:
+                    await database_sync_to_async(event_handler)(event)
+
+    @database_sync_to_async
+    def _save_event(self, group, content):
+        presence.heartbeat(group, self.get_participant())
+        with stats.track('saving event object to database'):
+            event = Event(
+                group=group,
+                participant=self.get_participant(),
+                channel=content['channel'],
+                value=content['payload'])
+            writer.write(event)
+        return event
+
+    async def redwood_send_to_group(self, event):
+        self.outbound.put(event['text'])
+        await self.send_outbound()
+        if self.outbound:
+            stats.increment('outbound frames held back')
+
+    async def send_outbound(self):
+        msg = self.next_outbound()
+        while msg is not None:
+            await self.send_json(msg)
+            msg = self.next_outbound()
+
+
+class AsyncEventWatcher(CodecMixin, AsyncJsonWebsocketConsumer):
+    """Asynchronous version of :class:`EventWatcher`."""
+
+    url_pattern = EventWatcher.url_pattern
+
+    async def connect(self):
+        self.session_code = self.scope['url_route']['kwargs']['session_code']
+        self.events_group_name = watchers.group_name(self.session_code)
+        await self.channel_layer.group_add(
+            self.events_group_name,
+            self.channel_name
+        )
+        watchers.subscribe(self.session_code)
+        await self.accept(self.negotiate_codec())
+
+    async def disconnect(self, close_code):
+        watchers.unsubscribe(self.session_code)
+        await self.channel_layer.group_discard(
+            self.events_group_name,
+            self.channel_name
+        )
+
+    async def send_json(self, content, close=False):
+        await self.send(close=close, **self.encode_frame(content))
+
+    async def redwood_send_to_watcher(self, event):
+        msg = event['text']
+        await self.send_json(msg)
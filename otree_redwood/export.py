@@ -0,0 +1,242 @@
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db.models import Max, Q
+from django.utils import timezone
+import datetime
+import heapq
+
+from otree_redwood import archive, utils, writer
+from otree_redwood.consumers import get_group_model
+from otree_redwood.models import Event
+
+
+def chunk_size():
+    """Number of Events fetched from the database at a time when exporting. Set with
+    ``REDWOOD_EXPORT_CHUNK_SIZE`` in settings.py.
+    """
+    return getattr(settings, 'REDWOOD_EXPORT_CHUNK_SIZE', 2000)
+
+
+def settle_time():
+    """Seconds, on top of the Event writer's batch interval, before an Event is
+    reported as the latest one. Set with ``REDWOOD_EXPORT_SETTLE_TIME`` in settings.py.
+    """
+    return getattr(settings, 'REDWOOD_EXPORT_SETTLE_TIME', 1)
+
+
+def settled_before():
+    """Events created before this time are assumed to be visible in the database,
+    along with every Event with a lower id.
+
+    Event ids are handed out when Events are inserted, not when they become visible:
+    an Event in the writer's batch or in another process's open transaction can show
+    up after Events with higher ids. A ``since`` cursor that moved past it would skip
+    it, so cursors only advance to Events older than the batch interval plus
+    :func:`settle_time`.
+    """
+    return timezone.now() - datetime.timedelta(seconds=writer.batch_interval() + settle_time())
+
+
+def session_apps(session):
+    """Names of the apps in the session's app sequence, in order."""
+    apps = []
+    for app_name in session.config['app_sequence']:
+        if app_name in apps:
+            continue
+        try:
+            get_group_model(app_name)
+        except (ImportError, AttributeError):
+            continue
+        apps.append(app_name)
+    return apps
+
+
+def app_events(session, app_name, **filters):
+    """Iterates over the Events of every group of the app in the session; see :func:`iter_events`."""
+    group_model = get_group_model(app_name)
+    return iter_events(group_model.objects.filter(session=session), **filters)
+
+
+def _order(event):
+    return (event.group_pk, event.timestamp, event.id)
+
+
+def iter_events(groups, **filters):
+    """Iterates over the Events of the groups in the queryset in the order of
+    :func:`group_events`, fetching them in chunks. Events of groups that have been
+    archived and deleted from the Event table are read from the archive.
+    """
+    stored = group_events(groups, **filters).iterator(chunk_size=chunk_size())
+    return heapq.merge(stored, archive.events(groups, **filters), key=_order)
+
+
+def group_events(groups, channels=None, group_pk=None, participant_code=None,
+                 start=None, end=None, since=None, until=None, after=None):
+    """Returns the Events of every group in the ``groups`` queryset in one query,
+    ordered by group, then timestamp, then id, with the participant code fetched in
+    the same query.
+
+    ``since`` and ``until`` bound the Event ids: only Events with ``since < id <= until``
+    are returned. Take ``until`` from :func:`last_event`, which lags behind the newest
+    Events so that none with a lower id are still to become visible. ``after`` is a ``(group_pk, timestamp, id)`` tuple; only Events after
+    it in that order are returned.
+    """
+    events = Event.objects.filter(
+        content_type=ContentType.objects.get_for_model(groups.model),
+        group_pk__in=groups.values('pk'))
+    if channels:
+        events = events.filter(channel__in=channels)
+    if group_pk is not None:
+        events = events.filter(group_pk=group_pk)
+    if participant_code is not None:
+        events = events.filter(participant__code=participant_code)
+    if start is not None:
+        events = events.filter(timestamp__gte=start)
+    if end is not None:
+        events = events.filter(timestamp__lt=end)
+    if since is not None:
+        events = events.filter(id__gt=since)
+    if until is not None:
+        events = events.filter(id__lte=until)
+    if after is not None:
+        after_group_pk, after_timestamp, after_id = after
+        events = events.filter(
+            Q(group_pk__gt=after_group_pk) |
+            Q(group_pk=after_group_pk, timestamp__gt=after_timestamp) |
+            Q(group_pk=after_group_pk, timestamp=after_timestamp, id__gt=after_id))
+    return events.select_related('participant').only(
+        'id', 'timestamp', 'group_pk', 'channel', 'value', 'participant__code',
+    ).order_by('group_pk', 'timestamp', 'id')
+
+
+def last_event(groups):
+    """Returns ``{'id': ..., 'timestamp': ...}`` of the latest Event of the groups in
+    the queryset created before :func:`settled_before`, both None if there are none.
+    """
+    latest = Event.objects.filter(
+        content_type=ContentType.objects.get_for_model(groups.model),
+        group_pk__in=groups.values('pk'),
+        timestamp__lt=settled_before(),
+    ).aggregate(id=Max('id'), timestamp=Max('timestamp'))
+    return _latest(latest, archive.last_event(groups))
+
+
+def _latest(a, b):
+    return {
+        key: max(value for value in [a[key], b[key]] if value is not None)
+        if a[key] is not None or b[key] is not None else None
+        for key in a
+    }
+
+
+def session_last_event(session):
+    """Returns ``{'id': ..., 'timestamp': ...}`` of the latest Event in the session."""
+    latest = {'id': None, 'timestamp': None}
+    for app_name in session_apps(session):
+        latest = _latest(latest, last_event(get_group_model(app_name).objects.filter(session=session)))
+    return latest
+
+
+def cache_timeout():
+    """Seconds the output table of a group whose period has ended is kept in the
+    Django cache. Set with ``REDWOOD_EXPORT_CACHE_TIMEOUT`` in settings.py; 0 turns
+    the cache off.
+    """
+    return getattr(settings, 'REDWOOD_EXPORT_CACHE_TIMEOUT', 24 * 60 * 60)
+
+
+def last_event_ids(groups):
+    """Returns a map from group pk to the id of the group's latest Event, archived or not,
+    for the groups in the queryset that have any.
+    """
+    ids = dict(Event.objects.filter(
+        content_type=ContentType.objects.get_for_model(groups.model),
+        group_pk__in=groups.values('pk'),
+    ).values_list('group_pk').annotate(Max('id')).order_by())
+    for _, pk, entry in archive._deleted_entries(groups):
+        if entry['last_id'] is not None:
+            ids[pk] = max(ids.get(pk, 0), entry['last_id'])
+    return ids
+
+
+def table_cache_key(get_output_table, group, last_event_id):
+    return 'redwood-export-table:{}:{}:{}:{}:{}'.format(
+        get_output_table.__module__,
+        utils.code_version(get_output_table),
+        group._meta.label,
+        group.pk,
+        last_event_id)
+
+
+def output_tables(get_output_table, groups):
+    """Yields ``(group, rows)`` with the output table of each of the groups, which must
+    be in pk order. Events of every group are fetched in one query. Tables of groups
+    whose period has ended are cached, keyed by their latest Event id so Events written
+    after the period end are included, and those groups' Events aren't fetched again.
+    """
+    if not groups:
+        return
+    model = type(groups[0])
+    ended = [group for group in groups if getattr(group, 'period_end_time', None) and cache_timeout()]
+    last_ids = last_event_ids(model.objects.filter(pk__in=[group.pk for group in ended])) if ended else {}
+    ended = {
+        group.pk: table_cache_key(get_output_table, group, last_ids.get(group.pk))
+        for group in ended
+    }
+    cached = cache.get_many(ended.values()) if ended else {}
+    uncached = [group for group in groups if ended.get(group.pk) not in cached]
+    streams = getattr(get_output_table, 'redwood_streams_events', False)
+    events = iter_events(model.objects.filter(pk__in=[group.pk for group in uncached]))
+    tables = events_by_group(uncached, events)
+    for group in groups:
+        key = ended.get(group.pk)
+        if key in cached:
+            yield group, cached[key]
+            continue
+        _, events_of_group = next(tables)
+        rows = get_output_table(events_of_group if streams else list(events_of_group))
+        if key is None:
+            yield group, rows
+        else:
+            rows = list(rows)
+            cache.set(key, rows, cache_timeout())
+            yield group, rows
+
+
+def events_by_group(groups, events):
+    """Splits Events ordered by group into one iterator per group. Yields a
+    ``(group, events)`` pair for each of the groups, which must be in pk order; any
+    Events left unread when the next group is requested are skipped.
+    """
+    events = iter(events)
+    pending = [next(events, None)]
+
+    def take(pk):
+        while pending[0] is not None and pending[0].group_pk == pk:
+            yield pending[0]
+            pending[0] = next(events, None)
+
+    for group in groups:
+        while pending[0] is not None and pending[0].group_pk < group.pk:
+            pending[0] = next(events, None)
+        events_of_group = take(group.pk)
+        yield group, events_of_group
+        for _ in events_of_group:
+            pass
+
+
+def streams_events(get_output_table):
+    """Decorator for an app's ``get_output_table`` that makes the CSV export pass it
+    an iterator over the group's Events instead of a list, so a large group's Events
+    don't have to be held in memory at once.
+    """
+    get_output_table.redwood_streams_events = True
+    return get_output_table
+
+
+class Echo():
+    """File-like object that returns what is written, for streaming a csv.writer."""
+
+    def write(self, value):
+        return value
@@ -0,0 +1,143 @@
+from otree_redwood import archive
+from otree_redwood.archive import np, require_numpy
+
+
+class DecisionHistory():
+    """The decision path of every player in a :class:`~otree_redwood.models.DecisionGroup`
+    period as NumPy arrays. Decisions are piecewise constant: each player holds their
+    initial decision until their first change, and each change holds until the next.
+
+    :attr:`participants` lists the participant codes, in ``id_in_group`` order. Each change
+    ``i`` happened :attr:`times`\\[i] seconds after the period started, by participant
+    :attr:`participants`\\[:attr:`participant`\\[i]], to decision :attr:`decisions`\\[i].
+    :attr:`initial` holds each participant's initial decision, and each row of
+    :attr:`snapshots` every participant's decision as recorded in one ``group_decisions``
+    Event. Decisions that aren't numbers are NaN.
+    """
+
+    def __init__(self, participants, initial, times, participant, decisions, period_length, snapshots=None):
+        self.participants = participants
+        self.initial = np.asarray(initial, dtype=np.float64)
+        self.times = np.asarray(times, dtype=np.float64)
+        self.participant = np.asarray(participant, dtype=np.intp)
+        self.decisions = np.asarray(decisions, dtype=np.float64)
+        self.period_length = period_length
+        if snapshots is None:
+            snapshots = np.empty((0, len(participants)))
+        self.snapshots = np.asarray(snapshots, dtype=np.float64).reshape(-1, len(participants))
+
+    def at(self, times):
+        """Returns a ``(len(times), len(participants))`` array of every participant's
+        decision at each of the given times, in seconds since the period start.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        result = np.empty((len(times), len(self.participants)))
+        for i in range(len(self.participants)):
+            mine = self.participant == i
+            changes, decisions = self.times[mine], self.decisions[mine]
+            index = np.searchsorted(changes, times, side='right') - 1
+            result[:, i] = np.where(index >= 0, decisions[np.maximum(index, 0)] if len(decisions) else 0, self.initial[i])
+        return result
+
+    def segments(self, start=0, end=None):
+        """Splits ``[start, end)`` into the intervals over which no decision changes.
+        Returns ``(starts, durations, decisions)``, where ``decisions`` is a
+        ``(len(starts), len(participants))`` array of the decisions held over each interval.
+        """
+        end = self.period_length if end is None else end
+        inside = self.times[(self.times > start) & (self.times < end)]
+        starts = np.unique(np.concatenate([[start], inside]))
+        durations = np.diff(np.append(starts, end))
+        return starts, durations, self.at(starts)
+
+    def time_weighted_average(self, start=0, end=None):
+        """Each participant's decision averaged over ``[start, end)``, weighted by how long it was held."""
+        end = self.period_length if end is None else end
+        _, durations, decisions = self.segments(start, end)
+        return (decisions * durations[:, None]).sum(axis=0) / (end - start)
+
+    def resample(self, step):
+        """Returns ``(grid, decisions)``: a grid of times every ``step`` seconds over the
+        period, and every participant's decision at each of them.
+        """
+        grid = np.arange(0, self.period_length, step)
+        return grid, self.at(grid)
+
+    def subperiod_snapshots(self, num_subperiods):
+        """Every participant's decision at the end of each of ``num_subperiods`` equal
+        sub-periods: the first ``num_subperiods`` :attr:`snapshots`, as in sub-period mode
+        one ``group_decisions`` Event is sent per sub-period. Sub-periods whose snapshot
+        wasn't recorded take the decisions held at their end.
+        """
+        snapshots = self.snapshots[:num_subperiods]
+        if len(snapshots) < num_subperiods:
+            ends = self.period_length * np.arange(len(snapshots) + 1, num_subperiods + 1) / num_subperiods
+            snapshots = np.concatenate([snapshots, self.at(ends)])
+        return snapshots
+
+
+def _number(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return np.nan
+
+
+def _channel_rows(group, channel):
+    """``(timestamp, value)`` of every Event of the group on the channel, in order,
+    including Events that have been archived and deleted.
+    """
+    rows = list(group.events.filter(channel=channel).order_by('timestamp', 'id').values_list('timestamp', 'value'))
+    groups = type(group).objects.filter(pk=group.pk)
+    archived = [
+        (event.timestamp, event.value)
+        for event in archive.events(groups, channels=[channel])
+    ]
+    if archived:
+        rows = sorted(archived + rows, key=lambda row: row[0])
+    return rows
+
+
+def _initial_decisions(group, rows):
+    """The decisions the period started with, as recorded on the ``initial_decisions``
+    channel. Periods recorded without it fall back to the first ``group_decisions``
+    Event, then to the saved :attr:`~otree_redwood.models.DecisionGroup.group_decisions`.
+    """
+    recorded = _channel_rows(group, 'initial_decisions')
+    if recorded:
+        return recorded[0][1]
+    initial = dict(group.group_decisions or {})
+    if rows:
+        initial.update(rows[0][1])
+    return initial
+
+
+def decision_history(group):
+    """Builds the :class:`DecisionHistory` of a DecisionGroup from its ``group_decisions``
+    Events, fetching only their timestamps and values.
+    """
+    require_numpy()
+    participants = list(group.player_set.order_by('id_in_group').values_list('participant__code', flat=True))
+    index = {code: i for i, code in enumerate(participants)}
+
+    rows = _channel_rows(group, 'group_decisions')
+    last = _initial_decisions(group, rows)
+    initial = [_number(last.get(code)) for code in participants]
+    start = group.period_start_time
+    if start is None:
+        start = group.events.filter(channel='state', value='period_start').values_list('timestamp', flat=True).first()
+    if start is None and rows:
+        start = rows[0][0]
+    end = group.period_end_time
+    period_length = (end - start).total_seconds() if end and start else group.period_length()
+
+    times, participant, decisions, snapshots = [], [], [], []
+    for timestamp, value in rows:
+        t = (timestamp - start).total_seconds()
+        for code, decision in value.items():
+            if code in index and last.get(code) != decision:
+                last[code] = decision
+                times.append(t)
+                participant.append(index[code])
+                decisions.append(_number(decision))
+        snapshots.append([_number(last.get(code)) for code in participants])
+    return DecisionHistory(participants, initial, times, participant, decisions, period_length, snapshots)
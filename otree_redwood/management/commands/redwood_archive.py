@@ -0,0 +1,76 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+
+from otree.models import Session
+from otree_redwood import archive, export
+from otree_redwood.consumers import get_group_model
+from otree_redwood.models import Event
+
+
+class Command(BaseCommand):
+    help = ('Compact the Events of finished sessions into a columnar archive of '
+            'memory-mappable .npy files per app and group, optionally deleting the '
+            'archived rows from the Event table. The export views and the events API '
+            'read deleted groups from the archive.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('session_codes', nargs='+')
+        parser.add_argument(
+            '--delete', action='store_true',
+            help='Delete the archived Events from the Event table')
+        parser.add_argument(
+            '--force', action='store_true',
+            help="Archive groups whose period hasn't ended")
+
+    def handle(self, **options):
+        archive.require_numpy()
+        self.stdout.write('Archiving to {}'.format(archive.archive_dir()))
+        for code in options['session_codes']:
+            try:
+                session = Session.objects.get(code=code)
+            except Session.DoesNotExist:
+                raise CommandError('no session {}'.format(code))
+            manifest = archive.read_manifest(code) or {'session': code, 'apps': {}}
+            for app_name in export.session_apps(session):
+                self.archive_app(session, app_name, manifest, options)
+                archive.write_manifest(code, manifest)
+                if options['delete']:
+                    self.delete_app(app_name, manifest)
+
+    def archive_app(self, session, app_name, manifest, options):
+        model = get_group_model(app_name)
+        groups = model.objects.filter(session=session).order_by('pk')
+        group_list = list(groups)
+        running = [group.pk for group in group_list if getattr(group, 'period_end_time', True) is None]
+        if running and not options['force']:
+            self.stderr.write('{} {}: skipped, the period of groups {} has not ended'.format(
+                session.code, app_name, running))
+            return
+        entries = manifest['apps'].setdefault(app_name, {})
+        events = export.group_events(groups).iterator(chunk_size=export.chunk_size())
+        archived = 0
+        for group, group_events in export.events_by_group(group_list, events):
+            if entries.get(str(group.pk), {}).get('deleted'):
+                continue
+            entries[str(group.pk)] = archive.write_group(session.code, app_name, group.pk, group_events)
+            archived += entries[str(group.pk)]['count']
+        self.stdout.write('{} {}: archived {} events of {} groups'.format(
+            session.code, app_name, archived, len(group_list)))
+
+    def delete_app(self, app_name, manifest):
+        content_type = ContentType.objects.get_for_model(get_group_model(app_name))
+        deleted = 0
+        for group_pk, entry in manifest['apps'].get(app_name, {}).items():
+            if entry['last_id'] is None:
+                continue
+            # Readers switch to the archive as soon as the manifest says so; deleting
+            # again is harmless if a previous run stopped before deleting.
+            if not entry['deleted']:
+                entry['deleted'] = True
+                archive.write_manifest(manifest['session'], manifest)
+            deleted += Event.objects.filter(
+                content_type=content_type,
+                group_pk=int(group_pk),
+                id__lte=entry['last_id'],
+            ).delete()[0]
+        self.stdout.write('{} {}: deleted {} archived events'.format(manifest['session'], app_name, deleted))
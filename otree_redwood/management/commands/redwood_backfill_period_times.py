@@ -0,0 +1,40 @@
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+
+from otree_redwood.models import Event, Group
+
+
+class Command(BaseCommand):
+    help = ('Fill in Group.period_start_time and Group.period_end_time from the '
+            'state channel Events of sessions run before they were recorded.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'session_codes', nargs='*',
+            help='If omitted, groups in all sessions are backfilled')
+
+    def handle(self, **options):
+        for model in apps.get_models():
+            if not issubclass(model, Group):
+                continue
+            groups = model.objects.filter(period_start_time__isnull=True)
+            if options['session_codes']:
+                groups = groups.filter(session__code__in=options['session_codes'])
+            group_pks = list(groups.values_list('pk', flat=True))
+            if not group_pks:
+                continue
+            content_type = ContentType.objects.get_for_model(model)
+            updated = 0
+            for value, field in [('period_start', 'period_start_time'), ('period_end', 'period_end_time')]:
+                events = Event.objects.filter(
+                    content_type=content_type,
+                    group_pk__in=group_pks,
+                    channel='state',
+                    value=value,
+                ).values_list('group_pk', 'timestamp')
+                for group_pk, timestamp in events:
+                    model.objects.filter(pk=group_pk).update(**{field: timestamp})
+                    updated += 1
+            self.stdout.write('{}: backfilled {} timestamps for {} groups'.format(
+                model._meta.label, updated, len(group_pks)))
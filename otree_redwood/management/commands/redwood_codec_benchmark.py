@@ -0,0 +1,73 @@
+import json
+import random
+import string
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from otree_redwood import wire
+
+
+class StdlibJsonCodec():
+    """Plain stdlib json, for comparison with the wire codecs."""
+
+    subprotocol = 'stdlib json'
+
+    def encode(self, content):
+        return json.dumps(content)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+def participant_code():
+    return ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(8))
+
+
+def group_decisions(num_players, decision):
+    return {
+        'channel': 'group_decisions',
+        'payload': {participant_code(): decision() for _ in range(num_players)},
+    }
+
+
+def payloads():
+    return [
+        ('ping', {'channel': 'ping', 'timestamp': 1541000000000.0}),
+        ('decision', {'channel': 'decisions', 'payload': 0.5}),
+        ('group_decisions x2', group_decisions(2, random.random)),
+        ('group_decisions x10', group_decisions(10, random.random)),
+        ('group_decisions x50', group_decisions(50, random.random)),
+        ('group_decisions x50 orders', group_decisions(50, lambda: {
+            'type': random.choice(['bid', 'ask']),
+            'price': round(random.uniform(0, 10), 2),
+            'quantity': random.randint(1, 10),
+        })),
+    ]
+
+
+class Command(BaseCommand):
+    help = ('Measure the encode/decode cost per message and frame size of each '
+            'available wire codec on typical redwood payloads.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--number', type=int, default=10000,
+            help='Number of encode/decode calls to time per payload and codec.')
+
+    def handle(self, **options):
+        number = options['number']
+        codecs = [StdlibJsonCodec()] + list(wire.codecs().values())
+        self.stdout.write('{:<28} {:<22} {:>10} {:>12} {:>12}'.format(
+            'payload', 'codec', 'bytes', 'encode (us)', 'decode (us)'))
+        for name, content in payloads():
+            for codec in codecs:
+                frame = codec.encode(content)
+                encode = timeit.timeit(lambda: codec.encode(content), number=number)
+                decode = timeit.timeit(lambda: codec.decode(frame), number=number)
+                self.stdout.write('{:<28} {:<22} {:>10} {:>12.2f} {:>12.2f}'.format(
+                    name,
+                    codec.subprotocol,
+                    len(frame),
+                    encode / number * 1e6,
+                    decode / number * 1e6))
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from otree_redwood.models import Event
+
+
+class Command(BaseCommand):
+    help = ('Report the size of the redwood Event table and the query plans '
+            'of the hot Event queries on the configured database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--create-indexes', action='store_true',
+            help=(
+                'Create any Event indexes that are missing from the database. '
+                'oTree creates tables without migrations, so databases created '
+                'before the indexes were added need this once.'))
+
+    def handle(self, **options):
+        if options['create_indexes']:
+            self.create_indexes()
+        self.report_size()
+        self.report_plans()
+
+    def existing_indexes(self):
+        with connection.cursor() as cursor:
+            return connection.introspection.get_constraints(cursor, Event._meta.db_table)
+
+    def create_indexes(self):
+        existing = self.existing_indexes()
+        with connection.schema_editor() as editor:
+            for index in Event._meta.indexes:
+                if index.name in existing:
+                    continue
+                self.stdout.write('Creating index {}'.format(index.name))
+                editor.add_index(Event, index)
+
+    def report_size(self):
+        table = Event._meta.db_table
+        self.stdout.write('Events: {}'.format(Event.objects.count()))
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_size_pretty(pg_total_relation_size(%s))', [table])
+                self.stdout.write('Table size (with indexes): {}'.format(cursor.fetchone()[0]))
+        existing = self.existing_indexes()
+        for index in Event._meta.indexes:
+            status = 'present' if index.name in existing else 'MISSING (run with --create-indexes)'
+            self.stdout.write('Index {}: {}'.format(index.name, status))
+
+    def report_plans(self):
+        try:
+            sample = Event.objects.order_by('-pk')[0]
+        except IndexError:
+            self.stdout.write('No events, skipping query plans.')
+            return
+        group_events = Event.objects.filter(content_type_id=sample.content_type_id, group_pk=sample.group_pk)
+        queries = [
+            ('latest state (EventConsumer.connect)',
+                group_events.filter(channel='state').order_by('-timestamp')[:1]),
+            ('period start/end (redwood_backfill_period_times)',
+                group_events.filter(channel='state', value='period_start')),
+            ('group decisions (DecisionGroup.get_group_decisions_events)',
+                group_events.filter(channel='group_decisions')),
+            ('all group events (exports)',
+                group_events),
+        ]
+        for name, queryset in queries:
+            self.stdout.write('')
+            self.stdout.write(name)
+            self.stdout.write(queryset.explain())
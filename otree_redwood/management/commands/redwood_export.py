@@ -0,0 +1,136 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import csv
+import datetime
+from importlib import import_module
+import math
+import multiprocessing
+import os
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+# Models are imported inside the functions: a spawned worker imports this module
+# to run init_worker before Django is set up.
+
+
+def output_table_functions(app_name):
+    module = import_module('{}.views'.format(app_name))
+    return module.get_output_table, module.get_output_table_header
+
+
+def close_connections():
+    """Drop database connections inherited from the parent process, so each worker
+    opens its own.
+    """
+    for connection in connections.all():
+        connection.close()
+
+
+def init_worker():
+    """Runs first in each worker. Spawned workers start without Django set up;
+    forked ones already are, and setup() does nothing.
+    """
+    django.setup()
+    close_connections()
+
+
+def pool_context():
+    """Fork where available so workers inherit the loaded project; otherwise the
+    platform default, relying on :func:`init_worker` to set Django up.
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def export_groups(app_name, group_pks):
+    """Runs in a worker process. Returns ``(group_pk, rows, event_count, seconds)``
+    for each of the groups, in pk order, fetching all of their Events in one query.
+    """
+    from otree_redwood import export
+    from otree_redwood.consumers import get_group_model
+    get_output_table, _ = output_table_functions(app_name)
+    streams = getattr(get_output_table, 'redwood_streams_events', False)
+    groups = get_group_model(app_name).objects.filter(pk__in=group_pks).order_by('pk')
+    group_list = list(groups)
+    events = export.iter_events(groups)
+    results = []
+    for group, group_events in export.events_by_group(group_list, events):
+        start = time.perf_counter()
+        group_events = list(group_events)
+        count = len(group_events)
+        rows = list(get_output_table(iter(group_events) if streams else group_events))
+        results.append((group.pk, rows, count, time.perf_counter() - start))
+    return results
+
+
+class Command(BaseCommand):
+    help = ("Export an app's output table to CSV offline, running its "
+            "get_output_table over the groups of a session in a pool of processes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('app_name', help='App whose views module defines get_output_table')
+        parser.add_argument('session_codes', nargs='*', help='If omitted, groups in all sessions are exported')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Number of worker processes (default: number of CPUs)')
+        parser.add_argument(
+            '--groups-per-task', type=int, default=None,
+            help='Groups whose Events each worker fetches and processes at a time')
+        parser.add_argument('--output', help='CSV file to write (default: named after the app and date)')
+
+    def handle(self, **options):
+        from otree_redwood.consumers import get_group_model
+        app_name = options['app_name']
+        try:
+            get_output_table, get_output_table_header = output_table_functions(app_name)
+        except (ImportError, AttributeError):
+            raise CommandError('{}.views does not define get_output_table and get_output_table_header'.format(app_name))
+
+        groups = get_group_model(app_name).objects.order_by('pk')
+        if options['session_codes']:
+            groups = groups.filter(session__code__in=options['session_codes'])
+        group_list = list(groups)
+        group_pks = [group.pk for group in group_list]
+        workers = max(1, options['workers'] or 1)
+        per_task = options['groups_per_task'] or max(1, math.ceil(len(group_pks) / (workers * 4)))
+        tasks = [group_pks[i:i + per_task] for i in range(0, len(group_pks), per_task)]
+
+        output = options['output'] or '{} Events (exported {}).csv'.format(app_name, datetime.date.today().isoformat())
+        self.stdout.write('Exporting {} groups of {} with {} workers to {}'.format(
+            len(group_pks), app_name, workers, output))
+
+        start = time.perf_counter()
+        timings = []
+        # Connections must not be shared with the forked workers.
+        close_connections()
+        with open(output, 'w', newline='') as f, \
+                ProcessPoolExecutor(max_workers=workers, mp_context=pool_context(), initializer=init_worker) as pool:
+            w = csv.writer(f)
+            w.writerow(get_output_table_header(group_list))
+            futures = {pool.submit(export_groups, app_name, pks): i for i, pks in enumerate(tasks)}
+            finished = {}
+            next_task = 0
+            done = 0
+            for future in as_completed(futures):
+                finished[futures[future]] = future.result()
+                # Write in group order, as soon as every earlier task has been written.
+                while next_task in finished:
+                    for group_pk, rows, count, seconds in finished.pop(next_task):
+                        w.writerows(rows)
+                        timings.append((seconds, group_pk, count))
+                        done += 1
+                        if options['verbosity'] >= 2:
+                            self.stdout.write('group {}: {} events in {:.2f}s'.format(group_pk, count, seconds))
+                    next_task += 1
+                self.stderr.write('{}/{} groups exported ({:.1f}s)'.format(
+                    done, len(group_pks), time.perf_counter() - start))
+
+        elapsed = time.perf_counter() - start
+        total = sum(seconds for seconds, _, _ in timings)
+        self.stdout.write('Exported {} groups in {:.2f}s ({:.2f}s of get_output_table across workers)'.format(
+            len(timings), elapsed, total))
+        for seconds, group_pk, count in sorted(timings, reverse=True)[:5]:
+            self.stdout.write('  slowest: group {} took {:.2f}s for {} events'.format(group_pk, seconds, count))
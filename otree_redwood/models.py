@@ -1,3 +1,4 @@
+from channels.db import database_sync_to_async
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
@@ -8,9 +9,11 @@ import json
 from jsonfield import JSONField
 import logging
 from otree.models import BaseGroup
+from otree_redwood import history, presence, scheduler
+from otree_redwood import state as group_state
+from otree_redwood import writer
 from otree_redwood.stats import track 
-from otree_redwood.utils import DiscreteEventEmitter
-import threading
+from otree_redwood.utils import DiscreteEventEmitter, close_metrics_log, metrics_dir
 import time
 
 
@@ -23,6 +26,12 @@ class Event(models.Model):
     class Meta:
         # Default to queries returning most recent Event first.
         ordering = ['timestamp']
+        # Every hot read filters on the Event's group and usually its channel,
+        # then orders by timestamp.
+        indexes = [
+            models.Index(fields=['content_type', 'group_pk', 'channel', 'timestamp'], name='redwood_event_channel_idx'),
+            models.Index(fields=['content_type', 'group_pk', 'timestamp'], name='redwood_event_group_idx'),
+        ]
 
     timestamp = models.DateTimeField(null=False)
     """Time the event was received or sent by the server."""
@@ -71,6 +80,23 @@ class Connection(models.Model):
         null=True,
         on_delete=models.CASCADE)
     """Each Participant should have only one connection."""
+    content_type = models.ForeignKey(ContentType, related_name='+', null=True, on_delete=models.CASCADE)
+    """Used to relate this Connection to an arbitrary Group."""
+    group_pk = models.PositiveIntegerField(null=True)
+    """Primary key of the Group the Participant is connected to."""
+    last_seen = models.DateTimeField(null=True)
+    """Time of the last heartbeat; Connections older than the heartbeat timeout are stale."""
+
+
+_group_generations = {}
+
+
+def group_generation(group_class, pk):
+    """Returns a counter that changes every time the given group is saved in this process.
+    Consumers compare it with :attr:`Group.cached_generation` to decide whether a cached
+    Group instance is stale. Saves in other processes are not counted.
+    """
+    return _group_generations.get((group_class, pk), 0)
 
 
 class Group(BaseGroup):
@@ -85,6 +111,10 @@ class Group(BaseGroup):
     """Set when the :meth:`when_all_players_ready` function has been run.
     Ensures run-only-once semantics.
     """
+    period_start_time = models.DateTimeField(null=True)
+    """Timestamp of the ``period_start`` message on the ``state`` channel."""
+    period_end_time = models.DateTimeField(null=True)
+    """Timestamp of the ``period_end`` message on the ``state`` channel."""
     events = GenericRelation(Event, content_type_field='content_type', object_id_field='group_pk')
     """Allows Group to query all Event models associated with it.
     This effectively adds an 'events' related name to the Event.group GenericForeignKey.
@@ -108,19 +138,13 @@ class Group(BaseGroup):
         """Returns a datetime.datetime object representing the time that this period started,
         or None if the period hasn't started yet.
         """
-        try:
-            return self.events.get(channel='state', value='period_start').timestamp
-        except Event.DoesNotExist:
-            return None
+        return self.period_start_time
 
     def get_end_time(self):
         """Returns a datetime.datetime object representing the time that this period ended.
         Returns None if :meth:`period_length` is not set, or if the period hasn't ended yet.
         """
-        try:
-            return self.events.get(channel='state', value='period_end').timestamp
-        except Event.DoesNotExist:
-            return None
+        return self.period_end_time
 
     def when_all_players_ready(self):
         """Implement this to perform an action for the group once all players are ready."""
@@ -138,22 +162,28 @@ class Group(BaseGroup):
         self.refresh_from_db()
         if self.ran_ready_function:
             return
-        for player in self.get_players():
-            if Connection.objects.filter(participant__code=player.participant.code).count() == 0:
-                return
-                
+        if not presence.all_connected(self):
+            return
+
         self.when_all_players_ready()
         self.ran_ready_function = timezone.now()
         self.save()
 
-        self.send('state', 'period_start')
+        self.period_start_time = self.send('state', 'period_start').timestamp
+        self.save(update_fields=['period_start_time'])
 
         if self.period_length():
             # TODO: Should replace this with something like Huey/Celery so it'll survive a server restart.
-            timer = threading.Timer(
-                self.period_length(),
-                lambda: self.send('state', 'period_end'))
-            timer.start()
+            scheduler.schedule(self.period_length(), self._on_period_end)
+
+    def _on_period_end(self):
+        """Called by the period timer :meth:`period_length` seconds after the period starts."""
+        self.period_end_time = self.send('state', 'period_end').timestamp
+        self.save(update_fields=['period_end_time'])
+        writer.flush()
+        presence.discard(self)
+        if metrics_dir():
+            close_metrics_log(self.session.code)
 
     def _on_disconnect(self, participant):
         """Trigger the :meth:`when_player_disconnects` callback."""
@@ -166,49 +196,142 @@ class Group(BaseGroup):
 
     def send(self, channel, payload):
         """Send a message with the given payload on the given channel.
-        Messages are broadcast to all players in the group.
+        Messages are broadcast to all players in the group. Returns the
+        recorded Event.
+        """
+        with track('send_channel=' + channel):
+            event = self._record(channel, payload)
+            self._broadcast(channel, payload)
+            return event
+
+    def _record(self, channel, payload):
+        """Record an Event on the given channel without broadcasting it."""
+        event = Event(group=self, channel=channel, value=payload)
+        # State changes are written immediately so that reconnecting
+        # players see them.
+        writer.write(event, immediate=(channel == 'state'))
+        return event
+
+    def _broadcast(self, channel, payload, **fields):
+        """Broadcast a message to all players in the group without recording it.
+        Extra fields are sent alongside the channel and payload.
+        """
+        channel_layer = get_channel_layer()
+        async_to_sync(channel_layer.group_send)(
+            str(self.pk),
+            self._group_message(channel, payload, **fields)
+        )
+
+    async def send_async(self, channel, payload):
+        """Coroutine version of :meth:`send`, for use from coroutine event handlers
+        running under :class:`otree_redwood.consumers.AsyncEventConsumer`.
         """
         with track('send_channel=' + channel):
-            with track('create event'):
-                Event.objects.create(
-                    group=self,
-                    channel=channel,
-                    value=payload)
+            event = await database_sync_to_async(self._record)(channel, payload)
             channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
+            await channel_layer.group_send(
                 str(self.pk),
-                {
-                'type': 'redwood.send_to_group',
-                'text': {
-                    'channel': channel,
-                    'payload': payload,
-                    }
-                }
+                self._group_message(channel, payload)
             )
+            return event
+
+    def _group_message(self, channel, payload, **fields):
+        text = {
+            'channel': channel,
+            'payload': payload,
+        }
+        text.update(fields)
+        return {
+            'type': 'redwood.send_to_group',
+            'text': text,
+        }
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot_json_fields()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._snapshot_json_fields(kwargs.get('fields'))
+
+    def _json_fields(self, fields=None):
+        """Attribute names of the loaded JSONFields, limited to ``fields`` if given."""
+        deferred = self.get_deferred_fields()
+        return [
+            field.attname for field in self._meta.concrete_fields
+            if isinstance(field, JSONField) and field.attname not in deferred
+            and (fields is None or field.attname in fields or field.name in fields)
+        ]
+
+    def _json_hash(self, attname):
+        return hash(self._meta.get_field(attname).get_prep_value(getattr(self, attname)))
+
+    def _snapshot_json_fields(self, fields=None):
+        """Remember the current contents of the JSONFields, to detect changes on save."""
+        hashes = self.__dict__.setdefault('_json_hashes', {})
+        for attname in self._json_fields(fields):
+            hashes[attname] = self._json_hash(attname)
+
+    def _changed_json_fields(self):
+        hashes = self.__dict__.get('_json_hashes', {})
+        return {
+            attname for attname in self._json_fields()
+            if attname not in hashes or hashes[attname] != self._json_hash(attname)
+        }
 
     def save(self, *args, **kwargs):
+        """Saves the group in a single UPDATE. oTree's fork of save-the-change only
+        writes fields that were assigned to, so JSONFields that were mutated in place,
+        such as ``group_decisions[code] = decision``, are detected by comparing them
+        with their contents when loaded or last saved, and added to the fields written.
+        JSONFields that haven't changed are left out, even if listed in ``update_fields``.
         """
-        BUG: Django save-the-change, which all oTree models inherit from,
-        doesn't recognize changes to JSONField properties. So saving the model
-        won't trigger a database save. This is a hack, but fixes it so any
-        JSONFields get updated every save. oTree uses a forked version of
-        save-the-change so a good alternative might be to fix that to recognize
-        JSONFields (diff them at save time, maybe?).
-        """
-        super().save(*args, **kwargs)
-        if self.pk is not None:
+        if self.pk is not None and not self._state.adding and not kwargs.get('force_insert'):
+            changed_json = self._changed_json_fields()
             update_fields = kwargs.get('update_fields')
-            json_fields = {}
-            for field in self._meta.get_fields():
-                if isinstance(field, JSONField) and (update_fields is None or field.attname in update_fields):
-                    json_fields[field.attname] = getattr(self, field.attname)
-            self.__class__._default_manager.filter(pk=self.pk).update(**json_fields)
+            if update_fields is not None:
+                json_fields = set(self._json_fields())
+                update_fields = [name for name in update_fields if name not in json_fields or name in changed_json]
+            elif getattr(self, '_changed_fields', None) is not None:
+                update_fields = set(self._changed_fields) | changed_json
+            if update_fields is not None:
+                if not update_fields:
+                    return
+                kwargs['update_fields'] = update_fields
+        super().save(*args, **kwargs)
+        self._snapshot_json_fields(kwargs.get('update_fields'))
+        self.invalidate_cached()
+
+    cached_generation = None
+    """The :func:`group_generation` this instance is up to date with."""
+
+    def cacheable(self):
+        """Whether consumers may keep this instance between messages instead of fetching
+        it for each one. Only safe when the group's mutable state is kept in process
+        memory, which already requires all players in the group to be connected to
+        the same server process. False by default.
+        """
+        return False
+
+    def invalidate_cached(self):
+        """Marks other Group instances for this row cached by consumers in this process
+        as stale, so they are fetched again on the next message. This instance stays
+        current. Called on every save.
+        """
+        key = (self.__class__, self.pk)
+        _group_generations[key] = _group_generations.get(key, 0) + 1
+        self.cached_generation = _group_generations[key]
     
     @property
     def app_name(self):
         return self.session.config['name']
 
 
+_DECISION_STATE_FIELDS = ['group_decisions', 'subperiod_group_decisions']
+
+
 class DecisionGroup(Group):
     """DecisionGroup receives Events on the ``decisions`` channel, then
     broadcasts them back to all members of the group on the ``group_decisions``
@@ -224,8 +347,10 @@ class DecisionGroup(Group):
     """:attr:`subperiod_group_decisions` is a copy of the state of
     :attr:`group_decisions` at the end of each subperiod."""
     _group_decisions_updated = models.BooleanField(default=False)
-    """:attr:`_group_decisions_updated` is a private field used with rate limiting to determine
-    whether group decisions need to be resent."""
+    """:attr:`_group_decisions_updated` is no longer used: rate limiting keeps whether group
+    decisions need to be resent in process memory. The field stays because the column
+    is NOT NULL without a database default, so in tables created with it, inserts
+    that left it out would fail until the database is reset."""
 
     def get_group_decisions_events(self):
         """Returns a list of all Event objects sent on the ``group_decisions`` channel so far, ordered
@@ -234,25 +359,111 @@ class DecisionGroup(Group):
         """
         return list(self.events.filter(channel='group_decisions'))
 
+    def get_decision_history(self):
+        """Returns the decision history of this period as NumPy arrays, with helpers for
+        time-weighted averages, resampling and sub-period snapshots. See
+        :class:`otree_redwood.history.DecisionHistory`. Requires numpy.
+        """
+        return history.decision_history(self)
+
+    def flow_payoff(self, decisions):
+        """Override to compute payoffs with :meth:`get_payoffs`. Given a ``(intervals, players)``
+        NumPy array of decisions, one column per player in ``id_in_group`` order, returns an
+        array of the same shape with each player's payoff per unit of time under those decisions.
+        None by default.
+        """
+        return None
+
+    def get_payoffs(self):
+        """Returns a map from participant code to payoff for this period, integrating
+        :meth:`flow_payoff` over the decision history once for the whole group; see
+        :func:`otree_redwood.payoffs.group_payoffs`. Call it from ``Player.set_payoff``.
+        Returns None if :meth:`flow_payoff` isn't overridden. Requires numpy.
+        """
+        if type(self).flow_payoff is DecisionGroup.flow_payoff:
+            return None
+        from otree_redwood import payoffs
+        return payoffs.group_payoffs(self, self.flow_payoff, self.num_subperiods())
+
     def num_subperiods(self):
         """Override to turn on sub-period behavior. None by default."""
         return None
     
     def rate_limit(self):
         """Override to turn on rate-limiting behavior. If used, the return value of rate_limit
-        determines the minimum time between broadcasted ::attr::`group_decisions` updates."""
+        determines the minimum time between broadcasted ::attr::`group_decisions` updates.
+
+        Decisions received within a window are coalesced in process memory and broadcast
+        once at the end of it, so as with :meth:`state_flush_interval` all players in a
+        group must be connected to the same server process. Unless
+        :meth:`state_flush_interval` is set, :attr:`group_decisions` is written back to
+        the database at most once per window, and not at all while no decisions arrive."""
+        return None
+
+    def delta_broadcasts(self):
+        """Override to broadcast only the changed entries of :attr:`group_decisions`.
+        The return value is the number of delta messages sent between full snapshots.
+        Delta messages carry ``delta: true`` and every ``group_decisions`` message
+        carries a ``version`` that increases by one per broadcast; the
+        ``<redwood-decision>`` component applies them. Full snapshots are still
+        recorded as Events. None by default.
+
+        The version counter is kept in process memory, so as with :meth:`rate_limit`
+        all players in a group must be connected to the same server process; otherwise
+        processes broadcast interleaved versions and clients drop deltas until the next
+        snapshot. After the period has ended only full snapshots are sent.
+        """
+        return None
+
+    def state_flush_interval(self):
+        """Override to keep :attr:`group_decisions` and :attr:`subperiod_group_decisions`
+        in process memory instead of saving them on every decision. The return value is the number of seconds between writes back to the
+        database; state is also written when the period ends. None by default.
+
+        The in-memory state is authoritative, so all players in a group must be
+        connected to the same server process.
+        """
         return None
 
+    def _state_flush_interval(self):
+        """Flush interval of the in-memory state, which rate limiting always uses."""
+        flush_interval = self.state_flush_interval()
+        if flush_interval is None and self.rate_limit() and not self.num_subperiods():
+            flush_interval = self.rate_limit()
+        return flush_interval
+
+    def cacheable(self):
+        """Groups keeping their decisions in process memory may be cached by consumers."""
+        return self._state_flush_interval() is not None
+
+    def _decision_state(self):
+        """Returns the shared in-memory state for this group with its values bound
+        to this instance, or None if neither :meth:`state_flush_interval` nor
+        :meth:`rate_limit` is set.
+        """
+        flush_interval = self._state_flush_interval()
+        if flush_interval is None:
+            return None
+        state = group_state.get(self, flush_interval)
+        state.load(self, _DECISION_STATE_FIELDS)
+        state.bind(self)
+        return state
+
     def when_all_players_ready(self):
-        """Initializes decisions based on ``player.initial_decision()``.
+        """Initializes decisions based on ``player.initial_decision()``, recording them
+        on the ``initial_decisions`` channel for :meth:`get_decision_history`.
         If :attr:`num_subperiods` is set, starts a timed task to run the
         sub-periods.
         """
         self.group_decisions = {}
         self.subperiod_group_decisions = {}
         for player in self.get_players():
-            self.group_decisions[player.participant.code] = player.initial_decision()
-            self.subperiod_group_decisions[player.participant.code] = player.initial_decision()
+            decision = player.initial_decision()
+            self.group_decisions[player.participant.code] = decision
+            self.subperiod_group_decisions[player.participant.code] = decision
+        self._record('initial_decisions', dict(self.group_decisions))
+        if self._state_flush_interval() is not None:
+            group_state.get(self, self._state_flush_interval()).seed(self, _DECISION_STATE_FIELDS)
         if self.num_subperiods():
             emitter = DiscreteEventEmitter(
                 self.period_length() / self.num_subperiods(), 
@@ -261,28 +472,92 @@ class DecisionGroup(Group):
                 self._subperiod_tick)
             emitter.start()
         elif self.rate_limit():
-            def _tick(current_interval, intervals):
-                self.refresh_from_db()
-                if self._group_decisions_updated:
-                    self.send('group_decisions', self.group_decisions)
-                    self._group_decisions_updated = False
-                    self.save(update_fields=['_group_decisions_updated'])
-
             update_period = self.rate_limit()
             emitter = DiscreteEventEmitter(
                 update_period, 
                 self.period_length(),
                 self,
-                _tick)
+                self._rate_limit_tick)
             emitter.start()
         self.save()
 
+    def _on_period_end(self):
+        """Broadcasts decisions still held back by :meth:`rate_limit` and writes any
+        in-memory decision state to the database before ending the period. The state is
+        dropped once :attr:`period_end_time` is set, so late ticks and decisions, which
+        skip ended periods, can't recreate it.
+        """
+        in_memory = self._state_flush_interval() is not None or self.delta_broadcasts()
+        if in_memory:
+            state = group_state.get(self)
+            with state.lock:
+                if self.rate_limit() and not self.num_subperiods() and state.memo.get('group_decisions_updated'):
+                    state.memo['group_decisions_updated'] = False
+                    self._send_group_decisions(state.get('group_decisions'))
+            state.flush()
+        super()._on_period_end()
+        if in_memory:
+            group_state.discard(self)
+
+    def _period_ended(self):
+        return self.period_end_time is not None
+
+    def _send_group_decisions(self, decisions):
+        """Records and broadcasts a copy of the given decisions on the ``group_decisions``
+        channel, as a delta against the previous broadcast if :meth:`delta_broadcasts` is set.
+        """
+        decisions = dict(decisions)
+        snapshot_interval = self.delta_broadcasts()
+        # The in-memory state is dropped when the period ends; don't recreate it.
+        if not snapshot_interval or self._period_ended():
+            self.send('group_decisions', decisions)
+            return
+        state = group_state.get(self)
+        with track('send_channel=group_decisions'), state.lock:
+            self._record('group_decisions', decisions)
+            last = state.memo.get('last_group_decisions')
+            version = state.memo.get('group_decisions_version', -1) + 1
+            deltas = state.memo.get('group_decisions_deltas', 0)
+            if last is None or deltas >= snapshot_interval:
+                self._broadcast('group_decisions', decisions, version=version)
+                deltas = 0
+            else:
+                changed = {key: value for key, value in decisions.items() if key not in last or last[key] != value}
+                self._broadcast('group_decisions', changed, version=version, delta=True)
+                deltas += 1
+            state.memo['last_group_decisions'] = decisions
+            state.memo['group_decisions_version'] = version
+            state.memo['group_decisions_deltas'] = deltas
+
+    def _rate_limit_tick(self, current_interval, intervals):
+        """Tick each :meth:`rate_limit` window, broadcasting group_decisions if any
+        decision arrived during it. Idle windows don't touch the database.
+        """
+        if self._period_ended():
+            return
+        state = self._decision_state()
+        with state.lock:
+            if not state.memo.get('group_decisions_updated'):
+                return
+            state.memo['group_decisions_updated'] = False
+            self._send_group_decisions(self.group_decisions)
+
     def _subperiod_tick(self, current_interval, intervals):
-        """Tick each sub-period, copying group_decisions to subperiod_group_decisions.""" 
+        """Tick each sub-period, copying group_decisions to subperiod_group_decisions.
+        A tick running late after the period ended works on the saved decisions, as
+        the in-memory state has been written back and dropped.
+        """
+        state = None if self._period_ended() else self._decision_state()
+        if state:
+            with state.lock:
+                self.subperiod_group_decisions.update(self.group_decisions)
+                state.mark_dirty('subperiod_group_decisions')
+                self._send_group_decisions(self.subperiod_group_decisions)
+            return
         self.refresh_from_db()
         for key, value in self.group_decisions.items():
             self.subperiod_group_decisions[key] = value
-        self.send('group_decisions', self.subperiod_group_decisions)
+        self._send_group_decisions(self.subperiod_group_decisions)
         self.save(update_fields=['subperiod_group_decisions'])
 
     def _on_decisions_event(self, event=None, **kwargs):
@@ -293,9 +568,20 @@ class DecisionGroup(Group):
         if not self.ran_ready_function:
             logger.warning('ignoring decision from {} before when_all_players_ready: {}'.format(event.participant.code, event.value))
             return
+        if self._period_ended():
+            logger.warning('ignoring decision from {} after the period ended: {}'.format(event.participant.code, event.value))
+            return
         with track('_on_decisions_event'):
+            state = self._decision_state()
+            if state:
+                with state.lock:
+                    self.group_decisions[event.participant.code] = event.value
+                    state.memo['group_decisions_updated'] = True
+                    state.mark_dirty('group_decisions')
+                    if not self.num_subperiods() and not self.rate_limit():
+                        self._send_group_decisions(self.group_decisions)
+                return
             self.group_decisions[event.participant.code] = event.value
-            self._group_decisions_updated = True
-            self.save(update_fields=['group_decisions', '_group_decisions_updated'])
+            self.save(update_fields=['group_decisions'])
             if not self.num_subperiods() and not self.rate_limit():
-                self.send('group_decisions', self.group_decisions)
\ No newline at end of file
+                self._send_group_decisions(self.group_decisions)
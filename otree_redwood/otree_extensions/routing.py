@@ -1,9 +1,16 @@
+from django.conf import settings
 from django.conf.urls import url
-from otree_redwood.consumers import EventWatcher, EventConsumer
+from otree_redwood.consumers import AsyncEventConsumer, AsyncEventWatcher, EventWatcher, EventConsumer
 
 # NOTE: otree_extensions is part of
 # otree-core's private API, which may change at any time.
-websocket_routes = [
-    url(EventConsumer.url_pattern, EventConsumer),
-    url(EventWatcher.url_pattern, EventWatcher),
-]
\ No newline at end of file
+if getattr(settings, 'REDWOOD_ASYNC_CONSUMERS', False):
+    websocket_routes = [
+        url(AsyncEventConsumer.url_pattern, AsyncEventConsumer),
+        url(AsyncEventWatcher.url_pattern, AsyncEventWatcher),
+    ]
+else:
+    websocket_routes = [
+        url(EventConsumer.url_pattern, EventConsumer),
+        url(EventWatcher.url_pattern, EventWatcher),
+    ]
\ No newline at end of file
@@ -1,10 +1,11 @@
 from django.conf import urls
 from django.views.decorators.gzip import gzip_page
 
-from otree_redwood.views import DebugView, EventsJsonAPI
+from otree_redwood.views import DebugView, EventsJsonAPI, MetricsView
 
 
 urlpatterns = [
 	urls.url(DebugView.url_pattern, DebugView.as_view(), name=DebugView.url_name),
 	urls.url(EventsJsonAPI.url_pattern, gzip_page(EventsJsonAPI.as_view()), name=EventsJsonAPI.url_name),
+	urls.url(MetricsView.url_pattern, MetricsView.as_view(), name=MetricsView.url_name),
 ]
\ No newline at end of file
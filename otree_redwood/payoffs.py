@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from django.conf import settings
+import threading
+
+from otree_redwood.utils import code_version
+
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def cache_size():
+    """Number of groups whose payoffs are kept in memory. Set with
+    ``REDWOOD_PAYOFF_CACHE_SIZE`` in settings.py.
+    """
+    return getattr(settings, 'REDWOOD_PAYOFF_CACHE_SIZE', 1024)
+
+
+def group_payoffs(group, flow_payoff, num_subperiods=None):
+    """Returns each participant's payoff for the group's period as a map from participant
+    code to payoff, computed once for the whole group, or None if ``flow_payoff``
+    returns None.
+
+    ``flow_payoff`` is called with a ``(intervals, players)`` array of decisions, one
+    column per participant in ``id_in_group`` order, and returns an array of the same
+    shape with each player's payoff per unit of time under those decisions. In a
+    continuous period payoffs are the flow payoffs averaged over the period, weighted by
+    how long each set of decisions was held. With ``num_subperiods`` they are the flow
+    payoffs averaged over the decisions recorded at the end of each sub-period.
+
+    Results are cached per group once its period has ended, for the most recently
+    used :func:`cache_size` groups.
+    """
+    key = None
+    if group.period_end_time is not None:
+        key = (group._meta.label, group.pk, group.period_end_time, num_subperiods,
+               flow_payoff.__module__, getattr(flow_payoff, '__qualname__', None), code_version(flow_payoff))
+        with _lock:
+            if key in _cache:
+                _cache.move_to_end(key)
+                return _cache[key]
+
+    history = group.get_decision_history()
+    if num_subperiods:
+        flow = flow_payoff(history.subperiod_snapshots(num_subperiods))
+        payoffs = None if flow is None else flow.mean(axis=0)
+    else:
+        _, durations, decisions = history.segments()
+        flow = flow_payoff(decisions)
+        payoffs = None if flow is None else (flow * durations[:, None]).sum(axis=0) / durations.sum()
+    if payoffs is None:
+        return None
+    result = {code: float(payoff) for code, payoff in zip(history.participants, payoffs)}
+
+    if key is not None:
+        with _lock:
+            _cache[key] = result
+            while len(_cache) > cache_size():
+                _cache.popitem(last=False)
+    return result
@@ -0,0 +1,155 @@
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count
+from django.utils import timezone
+import datetime
+import threading
+import time
+
+from otree_redwood import stats
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def heartbeat_timeout():
+    """Seconds without a message or heartbeat after which a connection is
+    considered gone. Set with ``REDWOOD_HEARTBEAT_TIMEOUT`` in settings.py.
+    """
+    return getattr(settings, 'REDWOOD_HEARTBEAT_TIMEOUT', 30)
+
+
+class GroupPresence():
+    """Participants connected to a single group through this process. Removed from
+    the registry when the last of them disconnects.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.expected = None
+        self.last_seen = {}
+        self.last_saved = {}
+        self.removed = False
+
+    def live(self):
+        cutoff = time.monotonic() - heartbeat_timeout()
+        return {code for code, seen in self.last_seen.items() if seen >= cutoff}
+
+
+def _key(group):
+    return (group._meta.label, group.pk)
+
+
+def get(group):
+    key = _key(group)
+    with _registry_lock:
+        presence = _registry.get(key)
+        if presence is None:
+            presence = GroupPresence()
+            _registry[key] = presence
+    return presence
+
+
+def _connections(group):
+    from otree_redwood.models import Connection
+    return Connection.objects.filter(
+        content_type=ContentType.objects.get_for_model(group),
+        group_pk=group.pk)
+
+
+def _cutoff():
+    return timezone.now() - datetime.timedelta(seconds=heartbeat_timeout())
+
+
+def connect(group, participant):
+    """Record that the participant has connected to the group, and clear out
+    connections for the group that stopped sending heartbeats.
+    """
+    from otree_redwood.models import Connection
+    while True:
+        presence = get(group)
+        with presence.lock:
+            # A concurrent disconnect may have just removed it from the registry.
+            if presence.removed:
+                continue
+            now = time.monotonic()
+            presence.last_seen[participant.code] = now
+            presence.last_saved[participant.code] = now
+            break
+    _connections(group).filter(last_seen__lt=_cutoff()).delete()
+    Connection.objects.update_or_create(
+        participant=participant,
+        defaults={
+            'content_type': ContentType.objects.get_for_model(group),
+            'group_pk': group.pk,
+            'last_seen': timezone.now(),
+        })
+
+
+def heartbeat(group, participant):
+    """Record that the participant is still connected. The Connection row is only
+    touched once per half heartbeat timeout, or on every heartbeat for groups this
+    process no longer keeps, e.g. after the period has ended.
+    """
+    presence = _registry.get(_key(group))
+    if presence is not None:
+        with presence.lock:
+            now = time.monotonic()
+            presence.last_seen[participant.code] = now
+            if now - presence.last_saved.get(participant.code, 0) < heartbeat_timeout() / 2:
+                return
+            presence.last_saved[participant.code] = now
+    _connections(group).filter(participant=participant).update(last_seen=timezone.now())
+
+
+def disconnect(group, participant):
+    """Record that the participant has disconnected from the group."""
+    key = _key(group)
+    with _registry_lock:
+        presence = _registry.get(key)
+        if presence is not None:
+            with presence.lock:
+                presence.last_seen.pop(participant.code, None)
+                presence.last_saved.pop(participant.code, None)
+                if not presence.last_seen:
+                    presence.removed = True
+                    del _registry[key]
+    _connections(group).filter(participant=participant).delete()
+
+
+def all_connected(group):
+    """Returns True if every player in the group has a live connection. Answered
+    from memory when every player is connected to this process, otherwise with a
+    single aggregate query over the group's Connections.
+    """
+    presence = get(group)
+    with presence.lock:
+        if presence.expected is None:
+            presence.expected = frozenset(
+                group.player_set.values_list('participant__code', flat=True))
+        expected = presence.expected
+        if expected <= presence.live():
+            stats.increment('presence answered from memory')
+            return True
+    stats.increment('presence answered from database')
+    connected = _connections(group).filter(
+        participant__code__in=expected,
+        last_seen__gte=_cutoff(),
+    ).aggregate(n=Count('participant', distinct=True))['n']
+    return connected == len(expected)
+
+
+def connected_count():
+    """Number of participants with a live connection, across all groups and processes."""
+    from otree_redwood.models import Connection
+    return Connection.objects.filter(last_seen__gte=_cutoff()).count()
+
+
+def discard(group):
+    """Forget the presence of the given group, e.g. after the period has ended."""
+    with _registry_lock:
+        presence = _registry.pop(_key(group), None)
+        if presence is not None:
+            with presence.lock:
+                presence.removed = True
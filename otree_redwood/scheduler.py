@@ -0,0 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Task():
+    """A callback scheduled to run at a given ``time.monotonic()`` time."""
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        """Prevent the callback from running if it hasn't started yet."""
+        self.cancelled = True
+
+    def run(self):
+        if self.cancelled:
+            return
+        # Worker threads live as long as the process and get no request cycle, so
+        # connections that went stale or broke are dropped around each callback.
+        close_old_connections()
+        try:
+            self.callback()
+        except Exception:
+            logger.exception('error in scheduled callback {}'.format(self.callback))
+        finally:
+            close_old_connections()
+
+
+class Scheduler():
+    """Scheduler keeps every pending timer in one heap, served by a single timer
+    thread. Due callbacks are handed to a fixed pool of worker threads, so a slow
+    callback doesn't delay the others and no thread is created per timer.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._executor = None
+
+    def schedule(self, delay, callback):
+        """Run the callback ``delay`` seconds from now. Returns a cancellable Task."""
+        return self.schedule_at(time.monotonic() + delay, callback)
+
+    def schedule_at(self, when, callback):
+        """Run the callback at the given ``time.monotonic()`` time, or as soon as
+        possible if that time has passed. Returns a cancellable Task.
+        """
+        task = Task(when, callback)
+        with self._condition:
+            if self._thread is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                self._thread = threading.Thread(target=self._run, name='redwood-scheduler', daemon=True)
+                self._thread.start()
+            heapq.heappush(self._heap, (when, next(self._counter), task))
+            if self._heap[0][2] is task:
+                self._condition.notify()
+        return task
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                when, _, task = self._heap[0]
+                delay = when - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+            if not task.cancelled:
+                self._executor.submit(task.run)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Returns the scheduler shared by the whole process. The number of worker
+    threads is set with ``REDWOOD_SCHEDULER_WORKERS`` in settings.py.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(getattr(settings, 'REDWOOD_SCHEDULER_WORKERS', 8))
+        return _scheduler
+
+
+def schedule(delay, callback):
+    """Run the callback ``delay`` seconds from now on the shared scheduler."""
+    return get_scheduler().schedule(delay, callback)
+
+
+def schedule_at(when, callback):
+    """Run the callback at the given ``time.monotonic()`` time on the shared scheduler."""
+    return get_scheduler().schedule_at(when, callback)
@@ -0,0 +1,115 @@
+import atexit
+import threading
+
+from otree_redwood import scheduler
+
+
+_states = {}
+_states_lock = threading.Lock()
+
+
+def _key(group):
+    return (group._meta.label, group.pk)
+
+
+class GroupState():
+    """GroupState is the process-local, authoritative copy of a set of fields
+    on a single Group. Every Group instance for the same row in this process
+    shares one GroupState, so handlers and tick callbacks see a consistent view
+    without re-querying the database. Changed fields are written back to the
+    database at most once per flush interval, and whenever :meth:`flush` is
+    called explicitly.
+    """
+
+    def __init__(self, model, pk):
+        self.model = model
+        self.pk = pk
+        self.lock = threading.RLock()
+        self.values = {}
+        self.loaded = False
+        self.dirty = set()
+        self.flush_interval = None
+        self.flush_timer = None
+        # Process-local values that are never written to the database.
+        self.memo = {}
+
+    def load(self, group, fields):
+        """Populate the state from the given group the first time it is used
+        in this process.
+        """
+        with self.lock:
+            if not self.loaded:
+                group.refresh_from_db(fields=fields)
+                for field in fields:
+                    self.values[field] = getattr(group, field)
+                self.loaded = True
+
+    def seed(self, group, fields):
+        """Replace the state with the current values on the given group."""
+        with self.lock:
+            for field in fields:
+                self.values[field] = getattr(group, field)
+            self.loaded = True
+
+    def bind(self, group):
+        """Point the group's attributes at the shared values."""
+        with self.lock:
+            for field, value in self.values.items():
+                setattr(group, field, value)
+
+    def get(self, field):
+        return self.values[field]
+
+    def mark_dirty(self, *fields):
+        with self.lock:
+            self.dirty.update(fields)
+            if self.flush_interval is not None and self.flush_timer is None:
+                self.flush_timer = scheduler.schedule(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Write any changed fields to the database in a single UPDATE."""
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if not self.dirty:
+                return
+            update = {}
+            for field in self.dirty:
+                value = self.values[field]
+                # Shallow copy so the UPDATE can be serialized outside the lock.
+                update[field] = dict(value) if isinstance(value, dict) else value
+            self.dirty.clear()
+        self.model._default_manager.filter(pk=self.pk).update(**update)
+
+
+def get(group, flush_interval=None):
+    """Returns the GroupState shared by every instance of the given group in this process."""
+    key = _key(group)
+    with _states_lock:
+        state = _states.get(key)
+        if state is None:
+            state = GroupState(group.__class__, group.pk)
+            _states[key] = state
+    if flush_interval is not None:
+        state.flush_interval = flush_interval
+    return state
+
+
+def discard(group):
+    """Flush and forget the state for the given group."""
+    with _states_lock:
+        state = _states.pop(_key(group), None)
+    if state is not None:
+        state.flush()
+
+
+@atexit.register
+def flush_all():
+    """Flush the state of every group in this process. Runs when the process exits,
+    so that decisions made since the last flush aren't lost on shutdown.
+    """
+    with _states_lock:
+        states = list(_states.values())
+    for state in states:
+        state.flush()
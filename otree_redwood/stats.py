@@ -1,44 +1,347 @@
-from collections import defaultdict
-import mockredis
+from collections import deque
+from django.conf import settings
+import hashlib
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
 import time
 
+from otree_redwood import scheduler
 
-redis = None
+
+logger = logging.getLogger(__name__)
+
+
+# Histogram buckets are HDR-style: every doubling from MIN_VALUE is split into
+# SUB_BUCKETS linear buckets, so every percentile is within 12.5% of the true
+# value and each histogram uses the same constant amount of memory whatever it
+# records.
+MIN_VALUE = 1e-6
+SUB_BUCKETS = 8
+NUM_BUCKETS = 1 + SUB_BUCKETS * 48
+# Rates are computed from samples of the running counts taken every
+# PUBLISH_INTERVAL seconds over the last WINDOW seconds.
+PUBLISH_INTERVAL = 1
+WINDOW = 60
+RATE_WINDOWS = [1, 10, 60]
+
+
+def bucket_index(value):
+    if value <= MIN_VALUE:
+        return 0
+    mantissa, exponent = math.frexp(value / MIN_VALUE)
+    index = 1 + (exponent - 1) * SUB_BUCKETS + int((2 * mantissa - 1) * SUB_BUCKETS)
+    return index if index < NUM_BUCKETS else NUM_BUCKETS - 1
+
+
+def bucket_value(index):
+    """Upper bound of the values recorded in the given bucket."""
+    if index == 0:
+        return MIN_VALUE
+    octave, sub = divmod(index - 1, SUB_BUCKETS)
+    return MIN_VALUE * 2 ** octave * (1 + (sub + 1) / SUB_BUCKETS)
+
+
+class Sampled():
+    """Keeps samples of a running total so rates can be computed without timing
+    every update. Subclasses return the running total from ``total()``.
+    """
+
+    def __init__(self):
+        self.samples = deque(maxlen=WINDOW // PUBLISH_INTERVAL + 1)
+
+    def sample(self, now):
+        self.samples.append((now, self.total()))
+
+    def rates(self, now):
+        """Mean amount per second over each of the :data:`RATE_WINDOWS`."""
+        current = self.total()
+        rates = {}
+        for seconds in RATE_WINDOWS:
+            rate = 0.0
+            for sampled_at, total in self.samples:
+                if sampled_at >= now - seconds:
+                    if now > sampled_at:
+                        rate = (current - total) / (now - sampled_at)
+                    break
+            rates['rate_{}s'.format(seconds)] = rate
+        return rates
+
+
+class Histogram(Sampled):
+    """Histogram of the values recorded for one tracking context.
+
+    :meth:`record` takes no lock so that it stays cheap on the message path;
+    under heavy contention an occasional concurrent update may be lost.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.buckets = [0] * NUM_BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = -math.inf
+
+    def record(self, value):
+        self.buckets[bucket_index(value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def total(self):
+        return self.count
+
+    def snapshot(self, now):
+        snapshot = {
+            'buckets': {index: count for index, count in enumerate(self.buckets) if count},
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max if self.count else None,
+        }
+        snapshot.update(self.rates(now))
+        return snapshot
+
+
+class Counter(Sampled):
+    """Running total of an amount, e.g. rows written."""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def increment(self, amount):
+        with self.lock:
+            self.value += amount
+
+    def total(self):
+        return self.value
+
+    def snapshot(self, now):
+        snapshot = {'total': self.value}
+        snapshot.update(self.rates(now))
+        return snapshot
+
+
+def merge_histograms(a, b):
+    buckets = dict(a['buckets'])
+    for index, count in b['buckets'].items():
+        buckets[index] = buckets.get(index, 0) + count
+    merged = {
+        'buckets': buckets,
+        'count': a['count'] + b['count'],
+        'sum': a['sum'] + b['sum'],
+        'max': max(m for m in [a['max'], b['max']] if m is not None) if a['count'] or b['count'] else None,
+    }
+    for seconds in RATE_WINDOWS:
+        key = 'rate_{}s'.format(seconds)
+        merged[key] = a[key] + b[key]
+    return merged
+
+
+def merge_counters(a, b):
+    merged = {'total': a['total'] + b['total']}
+    for seconds in RATE_WINDOWS:
+        key = 'rate_{}s'.format(seconds)
+        merged[key] = a[key] + b[key]
+    return merged
+
+
+def percentile(snapshot, p):
+    if not snapshot['count']:
+        return None
+    rank = p / 100 * snapshot['count']
+    seen = 0
+    for index in sorted(snapshot['buckets']):
+        seen += snapshot['buckets'][index]
+        if seen >= rank:
+            return min(bucket_value(index), snapshot['max'])
+    return snapshot['max']
+
+
+def summarize(snapshot):
+    summary = {
+        'count': snapshot['count'],
+        'sum': snapshot['sum'],
+        'mean': snapshot['sum'] / snapshot['count'] if snapshot['count'] else None,
+        'p50': percentile(snapshot, 50),
+        'p90': percentile(snapshot, 90),
+        'p99': percentile(snapshot, 99),
+        'max': snapshot['max'],
+    }
+    for seconds in RATE_WINDOWS:
+        key = 'rate_{}s'.format(seconds)
+        summary[key] = snapshot[key]
+    return summary
+
+
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+_publisher = None
+
+
+def _ensure_publisher():
+    global _publisher
+    if _publisher is None:
+        _publisher = scheduler.schedule(PUBLISH_INTERVAL, publish)
+
+
+def histogram(context):
+    """Returns the Histogram for the given tracking context, creating it if needed."""
+    h = _histograms.get(context)
+    if h is None:
+        with _lock:
+            h = _histograms.setdefault(context, Histogram())
+            _ensure_publisher()
+    return h
+
+
+def counter(name):
+    """Returns the Counter with the given name, creating it if needed."""
+    c = _counters.get(name)
+    if c is None:
+        with _lock:
+            c = _counters.setdefault(name, Counter())
+            _ensure_publisher()
+    return c
+
+
+def stats_dir():
+    """Directory where every process on this host publishes its stats, so that
+    :func:`items` and :func:`counters` report the whole deployment. Set with
+    ``REDWOOD_STATS_DIR`` in settings.py; set it to None to keep stats per process.
+    Defaults to a directory in /dev/shm (or the temp directory) unique to the project.
+    """
+    default = None
+    if not hasattr(settings, 'REDWOOD_STATS_DIR'):
+        project = getattr(settings, 'BASE_DIR', os.getcwd())
+        base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        default = os.path.join(base, 'otree-redwood-stats-{}'.format(
+            hashlib.md5(str(project).encode('utf-8')).hexdigest()[:12]))
+    return getattr(settings, 'REDWOOD_STATS_DIR', default)
+
+
+def _local_snapshot(now):
+    with _lock:
+        histograms = dict(_histograms)
+        all_counters = dict(_counters)
+    return {
+        'pid': os.getpid(),
+        'time': now,
+        'histograms': {context: h.snapshot(now) for context, h in histograms.items()},
+        'counters': {name: c.snapshot(now) for name, c in all_counters.items()},
+    }
+
+
+def publish():
+    """Sample every histogram and counter for rates, and publish this process's
+    snapshot for the other processes. Runs every :data:`PUBLISH_INTERVAL` seconds.
+    """
+    global _publisher
+    try:
+        now = time.monotonic()
+        with _lock:
+            sampled = list(_histograms.values()) + list(_counters.values())
+        for s in sampled:
+            s.sample(now)
+        directory = stats_dir()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, '{}.json'.format(os.getpid()))
+            with open(path + '.tmp', 'w') as f:
+                json.dump(_local_snapshot(now), f)
+            os.replace(path + '.tmp', path)
+    except Exception:
+        logger.exception('error publishing redwood stats')
+    finally:
+        _publisher = scheduler.schedule(PUBLISH_INTERVAL, publish)
+
+
+def _remote_snapshots(now):
+    """Snapshots published by the other live processes on this host."""
+    directory = stats_dir()
+    if not directory or not os.path.isdir(directory):
+        return []
+    snapshots = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json') or name == '{}.json'.format(os.getpid()):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        # time.monotonic() is shared by every process on the host.
+        if now - snapshot['time'] > 5 * PUBLISH_INTERVAL:
+            try:
+                os.kill(snapshot['pid'], 0)
+            except OSError:
+                # Gone, or the pid now belongs to another user's process.
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            continue
+        for h in snapshot['histograms'].values():
+            h['buckets'] = {int(index): count for index, count in h['buckets'].items()}
+        snapshots.append(snapshot)
+    return snapshots
 
 
 class track():
 
     def __init__(self, context):
         self.context = context
-        global redis
-        if not redis:
-            redis = mockredis.mock_redis_client()
 
     def __enter__(self):
-        self.start = time.time()
+        self.start = time.perf_counter()
         return self
 
     def __exit__(self, type, value, traceback):
-        elapsed_time = float(time.time() - self.start)
+        elapsed_time = time.perf_counter() - self.start
         update(self.context, elapsed_time)
 
 
 def update(context, value):
-    key = 'redwood-{}'.format(context)
-    redis.hset(key, 'tracking_context', context)
-    redis.hincrbyfloat(key, 'sum', value)
-    redis.hincrbyfloat(key, 'count', 1)
-    redis.sadd('redwood-tracking-contexts', key)
-
-
-def items():
-    global redis
-    if not redis:
-        redis = mockredis.mock_redis_client()
-    items = {}
-    for key in redis.smembers('redwood-tracking-contexts'):
-        tracking_context = redis.hget(key, 'tracking_context')
-        items[tracking_context] = {}
-        mean = float(redis.hget(key, 'sum')) / float(redis.hget(key, 'count'))
-        items[tracking_context]['mean'] = mean
-    return items
\ No newline at end of file
+    h = _histograms.get(context) or histogram(context)
+    h.record(value)
+
+
+def increment(name, amount=1):
+    counter(name).increment(amount)
+
+
+def _deployment(key, merge, local=False):
+    now = time.monotonic()
+    snapshots = [_local_snapshot(now)]
+    if not local:
+        snapshots += _remote_snapshots(now)
+    merged = {}
+    for snapshot in snapshots:
+        for name, value in snapshot[key].items():
+            merged[name] = merge(merged[name], value) if name in merged else value
+    return merged
+
+
+def items(local=False):
+    """Returns a summary of every tracking context: the count, sum, mean, p50, p90,
+    p99 and max of its values, and the rate at which they were recorded over the last
+    1, 10 and 60 seconds. Includes every process on the host unless ``local`` is set.
+    """
+    return {
+        context: summarize(snapshot)
+        for context, snapshot in _deployment('histograms', merge_histograms, local).items()
+    }
+
+
+def counters(local=False):
+    """Returns the total and the 1, 10 and 60 second rates of every counter.
+    Includes every process on the host unless ``local`` is set.
+    """
+    return _deployment('counters', merge_counters, local)
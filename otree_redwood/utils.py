@@ -1,5 +1,55 @@
+from django.conf import settings
+import inspect
+import json
+import logging
+import os
 import threading
 import time
+import zlib
+
+from otree_redwood import scheduler, stats
+
+
+logger = logging.getLogger(__name__)
+_metrics_files = {}
+_metrics_lock = threading.Lock()
+
+
+def lateness_warning_fraction():
+    """Fraction of an emitter's interval a tick may run late before a warning is
+    logged. Set with ``REDWOOD_TICK_LATENESS_WARNING`` in settings.py.
+    """
+    return getattr(settings, 'REDWOOD_TICK_LATENESS_WARNING', 0.5)
+
+
+def metrics_dir():
+    """Directory of the per-session metrics logs, or None if they are off. Set with
+    ``REDWOOD_METRICS_DIR`` in settings.py.
+    """
+    return getattr(settings, 'REDWOOD_METRICS_DIR', None)
+
+
+def log_metrics(session_code, record):
+    """Appends the record as a JSON line to ``<session_code>.jsonl`` in :func:`metrics_dir`.
+    The file stays open until :func:`close_metrics_log`, and is reopened if written again.
+    """
+    line = json.dumps(record) + '\n'
+    with _metrics_lock:
+        log = _metrics_files.get(session_code)
+        if log is None:
+            os.makedirs(metrics_dir(), exist_ok=True)
+            log = open(os.path.join(metrics_dir(), '{}.jsonl'.format(session_code)), 'a')
+            _metrics_files[session_code] = log
+        log.write(line)
+        log.flush()
+
+
+def close_metrics_log(session_code):
+    """Closes the session's metrics log if it is open."""
+    with _metrics_lock:
+        log = _metrics_files.pop(session_code, None)
+        if log is not None:
+            log.close()
 
 
 _timers = {}
@@ -12,30 +62,87 @@ class DiscreteEventEmitter():
         self.intervals = self.period_length / self.interval
         self.callback = callback
         self.current_interval = 0
+        # Per-emitter histograms live and die with the emitter; only the global
+        # tick contexts are kept in otree_redwood.stats.
+        self.lateness = stats.Histogram()
+        self.duration = stats.Histogram()
+        self.offset = 0 if start_immediate else self.interval
+        self.timer = None
         if self.group not in _timers:
             # TODO: Should replace this with something like Huey/Celery so it'll survive a server restart.
-            self.timer = threading.Timer(0 if start_immediate else self.interval, self._tick)
-            _timers[self.group] = self.timer
+            self.registered = True
+            _timers[self.group] = self
         else:
-            self.timer = None
+            self.registered = False
 
     def _tick(self):
-        start = time.time()
+        scheduled = self._time
+        started = time.monotonic()
         self.callback(self.current_interval, self.intervals)
+        self._record_tick(scheduled, started, time.monotonic())
         self.current_interval += 1
         if self.current_interval < self.intervals:
-            self.timer = threading.Timer(self._time, self._tick)
-            _timers[self.group] = self.timer
-            self.timer.start()
+            self.timer = scheduler.schedule_at(self._time, self._tick)
     
     @property
     def _time(self):
-        return self.interval - ((time.time() - self.start_time) % self.interval)
+        """Scheduled time of the current interval's tick. Ticks are aligned to
+        start_time, so a late tick doesn't delay the ones after it.
+        """
+        return self.start_time + self.offset + self.current_interval * self.interval
+
+    def _record_tick(self, scheduled, started, finished):
+        """Record how late the tick started and how long its callback took, globally
+        and on this emitter, and in the session's metrics log.
+        """
+        lateness = started - scheduled
+        duration = finished - started
+        group_label = '{}:{}'.format(self.group._meta.app_label, self.group.pk)
+        stats.update('tick lateness', lateness)
+        stats.update('tick duration', duration)
+        self.lateness.record(lateness)
+        self.duration.record(duration)
+        if lateness > self.interval * lateness_warning_fraction():
+            logger.warning('tick {} of group {} started {:.1f}ms late (interval {:.1f}ms)'.format(
+                self.current_interval, group_label, lateness * 1e3, self.interval * 1e3))
+        if metrics_dir():
+            log_metrics(self.group.session.code, {
+                'group': group_label,
+                'tick': self.current_interval,
+                'interval': self.interval,
+                'lateness': lateness,
+                'duration': duration,
+                'time': time.time(),
+            })
 
     def start(self):
-        if self.timer:
-            self.start_time = time.time()
-            self.timer.start()
+        if self.registered:
+            self.start_time = time.monotonic()
+            self.timer = scheduler.schedule_at(self._time, self._tick)
 
     def stop(self):
-        del _timers[self.group]
+        if self.timer:
+            self.timer.cancel()
+        if self.registered:
+            del _timers[self.group]
+
+
+def _code_fingerprint(code):
+    consts = tuple(
+        _code_fingerprint(const) if inspect.iscode(const) else repr(const)
+        for const in code.co_consts
+    )
+    return (code.co_code, code.co_names, consts)
+
+
+def code_version(function):
+    """Changes whenever the source of the module defining the function changes, so
+    cached output is recomputed after the function or a helper next to it is edited.
+    Falls back to the function's bytecode, constants and names if the source isn't
+    available.
+    """
+    try:
+        source = inspect.getsource(inspect.getmodule(function))
+    except (OSError, TypeError):
+        source = repr(_code_fingerprint(function.__code__))
+    return zlib.crc32(source.encode('utf-8'))
@@ -1,59 +1,190 @@
+import base64
+import binascii
 from collections import defaultdict
 import csv
 import datetime
+import hashlib
+import itertools
 from importlib import import_module
+import json
 import vanilla
 
-import channels
-from django.http import HttpResponse, JsonResponse
+from channels.layers import get_channel_layer
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import condition
 from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.utils.dateparse import parse_datetime
 
 from otree.models import Session
 from otree.session import SESSION_CONFIGS_DICT
-from otree_redwood import stats
+from otree_redwood import export, presence, stats, utils, wire
+from otree_redwood.consumers import get_group_model
 from otree_redwood.models import Event, Connection
 
 
 def AppSpecificExportCSV(app_name, display_name, get_output_table, get_output_table_header):
 
+    def scope(request):
+        """Returns the groups to export for the request and a description for the file name."""
+        group_model = get_group_model(app_name)
+        groups = group_model.objects.all()
+        description = display_name
+        if 'session' in request.GET:
+            groups = groups.filter(session__code=request.GET['session'])
+            description = '{} {}'.format(display_name, request.GET['session'])
+        if 'start' in request.GET or 'end' in request.GET:
+            start = _parse_date(request.GET.get('start'))
+            end = _parse_date(request.GET.get('end'))
+            events = Event.objects.filter(content_type=ContentType.objects.get_for_model(group_model))
+            if start:
+                events = events.filter(timestamp__gte=start)
+            if end:
+                events = events.filter(timestamp__lt=end + datetime.timedelta(days=1))
+            groups = groups.filter(pk__in=events.values('group_pk'))
+            description = '{} {} to {}'.format(
+                description, request.GET.get('start', ''), request.GET.get('end', ''))
+        if 'since' in request.GET:
+            changed = Event.objects.filter(
+                content_type=ContentType.objects.get_for_model(group_model),
+                id__gt=int(request.GET['since']))
+            groups = groups.filter(pk__in=changed.values('group_pk'))
+        return groups.order_by('pk'), description
+
+    def latest(request):
+        if not hasattr(request, '_redwood_last_event'):
+            try:
+                groups, _ = scope(request)
+                request._redwood_last_event = export.last_event(groups)
+            except ValueError:
+                request._redwood_last_event = {'id': None, 'timestamp': None}
+        return request._redwood_last_event
+
+    def etag(request, *args, **kwargs):
+        return _etag(request, latest(request)['id'], utils.code_version(get_output_table))
+
+    def last_modified(request, *args, **kwargs):
+        return latest(request)['timestamp']
+
     class ExportCSV(vanilla.View):
+        """Streams the app's output table as CSV. ``?session=<code>`` exports a single
+        session, and ``?start=`` / ``?end=`` (YYYY-MM-DD) export the groups with Events
+        in that date range; with neither every group is exported. ``?since=<event id>``
+        exports only the groups with Events after that id; the id to pass next time is
+        in the ``X-Redwood-Last-Event-Id`` header. It lags a second or so behind the
+        newest Event, see :func:`otree_redwood.export.settled_before`.
+
+        Decorate ``get_output_table`` with :func:`otree_redwood.export.streams_events`
+        to receive each group's Events as an iterator instead of a list.
+        """
 
         url_name = 'redwood_export_{}'.format(app_name)
         url_pattern = '^{}/$'.format(url_name)
         app_name = app_name
         display_name = display_name
 
-        def get(request, *args, **kwargs):
-
-            models_module = import_module('{}.models'.format(app_name))
-            groups = models_module.Group.objects.all()
-
-            tables = []
-            for group in groups:
-                events = Event.objects.filter(
-                    content_type=ContentType.objects.get_for_model(group),
-                    group_pk=group.pk)
-                tables.append(get_output_table(list(events)))
+        @method_decorator(condition(etag_func=etag, last_modified_func=last_modified))
+        def get(self, request, *args, **kwargs):
+            try:
+                groups, description = scope(request)
+            except ValueError:
+                return JsonResponse({'error': 'invalid query parameters'}, status=400)
 
-            response = HttpResponse(content_type='text/csv')
+            response = StreamingHttpResponse(self.rows(groups), content_type='text/csv')
             response['Content-Disposition'] = 'attachment; filename="{}"'.format(
                 '{} Events (accessed {}).csv'.format(
-                    display_name,
+                    description,
                     datetime.date.today().isoformat()
                 )
             )
-
-            w = csv.writer(response)
-            w.writerow(get_output_table_header(list(groups)))
-            for rows in tables:
-                w.writerows(rows)
-
+            _set_last_event_id(response, latest(request)['id'], request)
             return response
 
+        def rows(self, groups):
+            w = csv.writer(export.Echo())
+            group_list = list(groups)
+            yield w.writerow(get_output_table_header(group_list))
+            for group, rows in export.output_tables(get_output_table, group_list):
+                for row in rows:
+                    yield w.writerow(row)
+
     return ExportCSV
 
 
+def _etag(request, last_event_id, *versions):
+    """ETag for an export of the Events up to last_event_id, for the request's query."""
+    return hashlib.md5('{} {} {}'.format(
+        request.get_full_path(), last_event_id, versions).encode('utf-8')).hexdigest()
+
+
+def _set_last_event_id(response, last_event_id, request):
+    if last_event_id is None:
+        last_event_id = request.GET.get('since', 0)
+    response['X-Redwood-Last-Event-Id'] = str(last_event_id)
+
+
+def _parse_date(value):
+    if not value:
+        return None
+    return timezone.make_aware(datetime.datetime.strptime(value, '%Y-%m-%d'))
+
+
+def _parse_time(value):
+    """Parses a time given in milliseconds since the epoch, like Event message timestamps."""
+    if value is None:
+        return None
+    return datetime.datetime.fromtimestamp(float(value) / 1e3, tz=datetime.timezone.utc)
+
+
+def encode_cursor(app_name, event):
+    return base64.urlsafe_b64encode(json.dumps(
+        [app_name, event.group_pk, event.timestamp.isoformat(), event.id]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Returns the ``(app_name, (group_pk, timestamp, id))`` position of a cursor."""
+    app_name, group_pk, timestamp, event_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return app_name, (int(group_pk), parse_datetime(timestamp), int(event_id))
+
+
+def session_latest(request, session_code):
+    if not hasattr(request, '_redwood_last_event'):
+        try:
+            session = Session.objects.get(code=session_code)
+        except Session.DoesNotExist:
+            request._redwood_last_event = {'id': None, 'timestamp': None}
+        else:
+            request._redwood_last_event = export.session_last_event(session)
+    return request._redwood_last_event
+
+
+def session_etag(request, session_code):
+    return _etag(request, session_latest(request, session_code)['id'])
+
+
+def session_last_modified(request, session_code):
+    return session_latest(request, session_code)['timestamp']
+
+
+@method_decorator(condition(etag_func=session_etag, last_modified_func=session_last_modified), name='get')
 class EventsJsonAPI(vanilla.ListView):
+    """Streams the Events of a session as ``{app_name: {group_pk: [message, ...]}}``,
+    fetching them in chunks so memory use doesn't grow with the session.
+
+    Query parameters filter the Events: ``channel`` (may be repeated), ``group``,
+    ``participant`` (a participant code), and ``start`` and ``end`` (in milliseconds
+    since the epoch, like message timestamps). With ``limit`` the response is
+    paginated and is instead ``{"events": {...}, "next": cursor}``; pass the cursor as
+    ``cursor`` to get the next page, until ``next`` is null.
+
+    ``since=<event id>`` returns only Events after that id. Each response holds the
+    Events up to the id in its ``X-Redwood-Last-Event-Id`` header, which is the
+    ``since`` to pass next time. That id lags a second or so behind the newest Event,
+    so that Events still being written with lower ids aren't skipped; see
+    :func:`otree_redwood.export.settled_before`. Responses carry an ETag and Last-Modified, so
+    fetching a finished session again costs a single query.
+    """
 
     url_name = 'redwood_events_json_api'
     url_pattern = r'^redwood/api/events/session/(?P<session_code>[a-zA-Z0-9_-]+)/$'
@@ -61,19 +192,70 @@ class EventsJsonAPI(vanilla.ListView):
 
     def render_to_response(self, context):
         session = Session.objects.get(code=self.kwargs['session_code'])
-        events_by_app_name_then_group = defaultdict(lambda: {})
-        for session_config in SESSION_CONFIGS_DICT.values():
-            app_name = session_config['name']
-            try:
-                groups_query = getattr(session, app_name + '_group')
-            except AttributeError:
-                continue
-            groups = list(groups_query.all())
-            if groups:
-                for group in groups:
-                    events = Event.objects.filter(group_pk=group.pk)
-                    events_by_app_name_then_group[app_name][group.pk] = [e.message for e in events]
-        return JsonResponse(events_by_app_name_then_group, safe=False)
+        params = self.request.GET
+        try:
+            filters = {
+                'channels': params.getlist('channel'),
+                'group_pk': int(params['group']) if 'group' in params else None,
+                'participant_code': params.get('participant'),
+                'start': _parse_time(params.get('start')),
+                'end': _parse_time(params.get('end')),
+                'since': int(params['since']) if 'since' in params else None,
+                'until': session_latest(self.request, session_code=self.kwargs['session_code'])['id'] or 0,
+            }
+            limit = int(params['limit']) if 'limit' in params else None
+            cursor = decode_cursor(params['cursor']) if 'cursor' in params else None
+        except (ValueError, TypeError, binascii.Error):
+            return JsonResponse({'error': 'invalid query parameters'}, status=400)
+        if limit is not None and limit <= 0:
+            return JsonResponse({'error': 'limit must be positive'}, status=400)
+        response = StreamingHttpResponse(
+            self.stream(session, filters, limit, cursor),
+            content_type='application/json')
+        _set_last_event_id(response, filters['until'] or None, self.request)
+        return response
+
+    def stream(self, session, filters, limit, cursor):
+        apps = export.session_apps(session)
+        after = None
+        if cursor is not None:
+            cursor_app, after = cursor
+            apps = apps[apps.index(cursor_app):] if cursor_app in apps else []
+        paginated = limit is not None
+        remaining = limit
+        next_cursor = None
+
+        yield '{"events": {' if paginated else '{'
+        first_app = True
+        for app_name in apps:
+            events = export.app_events(session, app_name, after=after, **filters)
+            after = None
+            if paginated:
+                events = itertools.islice(events, remaining)
+            group_pk = None
+            event = None
+            for event in events:
+                if event.group_pk != group_pk:
+                    if group_pk is None:
+                        yield '{}{}: {{'.format('' if first_app else ', ', json.dumps(app_name))
+                        first_app = False
+                    else:
+                        yield '], '
+                    group_pk = event.group_pk
+                    yield '{}: [{}'.format(json.dumps(str(group_pk)), wire.dumps(event.message))
+                else:
+                    yield ', ' + wire.dumps(event.message)
+                if paginated:
+                    remaining -= 1
+            if group_pk is not None:
+                yield ']}'
+            if paginated and remaining == 0:
+                next_cursor = encode_cursor(app_name, event)
+                break
+        if paginated:
+            yield '}}, "next": {}}}'.format(json.dumps(next_cursor))
+        else:
+            yield '}'
 
 
 class DebugView(vanilla.TemplateView):
@@ -85,14 +267,100 @@ class DebugView(vanilla.TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['stats'] = stats.items()
-        channel_layer = channels.asgi.get_channel_layer()
-        if 'statistics' in channel_layer.extensions:
-            context['global_channel_stats'] = channel_layer.global_statistics()
+        context['global_channel_stats'] = channel_layer_statistics()
         context['connected_participants'] = Connection.objects.all()
         context['session_code'] = self.kwargs['session_code']
         return context
 
- 
+
+def channel_layer_statistics():
+    """Returns the channel layer's global statistics, or None if it doesn't keep any."""
+    channel_layer = get_channel_layer()
+    if 'statistics' in getattr(channel_layer, 'extensions', []):
+        return channel_layer.global_statistics()
+    return None
+
+
+def collect_metrics():
+    """Returns the redwood hot-path metrics of every process on this host as a dictionary."""
+    contexts = stats.items()
+    channel_rates = defaultdict(dict)
+    for context, summary in contexts.items():
+        for prefix, direction in [('recv_channel=', 'recv'), ('send_channel=', 'send')]:
+            if context.startswith(prefix):
+                channel_rates[context[len(prefix):]][direction] = {
+                    key: value for key, value in summary.items() if key.startswith('rate_')
+                }
+    return {
+        'contexts': contexts,
+        'counters': stats.counters(),
+        'connected_participants': presence.connected_count(),
+        'channels': channel_rates,
+        'channel_layer': channel_layer_statistics(),
+    }
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(metrics):
+    """Formats the result of :func:`collect_metrics` in the Prometheus text exposition format."""
+    lines = []
+
+    lines.append('# TYPE redwood_tracked summary')
+    for context, summary in sorted(metrics['contexts'].items()):
+        for quantile, key in [('0.5', 'p50'), ('0.9', 'p90'), ('0.99', 'p99'), ('1', 'max')]:
+            if summary[key] is not None:
+                lines.append('redwood_tracked{{context="{}",quantile="{}"}} {}'.format(
+                    _label(context), quantile, summary[key]))
+        lines.append('redwood_tracked_sum{{context="{}"}} {}'.format(_label(context), summary['sum']))
+        lines.append('redwood_tracked_count{{context="{}"}} {}'.format(_label(context), summary['count']))
+
+    lines.append('# TYPE redwood_counter_total counter')
+    for name, summary in sorted(metrics['counters'].items()):
+        lines.append('redwood_counter_total{{name="{}"}} {}'.format(_label(name), summary['total']))
+
+    lines.append('# TYPE redwood_counter_rate gauge')
+    for name, summary in sorted(metrics['counters'].items()):
+        for seconds in stats.RATE_WINDOWS:
+            lines.append('redwood_counter_rate{{name="{}",window="{}s"}} {}'.format(
+                _label(name), seconds, summary['rate_{}s'.format(seconds)]))
+
+    lines.append('# TYPE redwood_channel_messages_rate gauge')
+    for channel, directions in sorted(metrics['channels'].items()):
+        for direction, rates in sorted(directions.items()):
+            for seconds in stats.RATE_WINDOWS:
+                lines.append('redwood_channel_messages_rate{{channel="{}",direction="{}",window="{}s"}} {}'.format(
+                    _label(channel), direction, seconds, rates['rate_{}s'.format(seconds)]))
+
+    lines.append('# TYPE redwood_connected_participants gauge')
+    lines.append('redwood_connected_participants {}'.format(metrics['connected_participants']))
+
+    if metrics['channel_layer']:
+        lines.append('# TYPE redwood_channel_layer gauge')
+        for name, value in sorted(metrics['channel_layer'].items()):
+            if isinstance(value, (int, float)):
+                lines.append('redwood_channel_layer{{stat="{}"}} {}'.format(_label(name), value))
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsView(vanilla.View):
+    """Machine-readable redwood metrics, in the Prometheus text format by default or as
+    JSON with ``?format=json``.
+    """
+
+    url_name = 'redwood_metrics'
+    url_pattern = r'^redwood/metrics/$'
+
+    def get(self, request, *args, **kwargs):
+        metrics = collect_metrics()
+        if request.GET.get('format') == 'json':
+            return JsonResponse(metrics)
+        return HttpResponse(prometheus_text(metrics), content_type='text/plain; version=0.0.4')
+
+
 app_specific_exports = []
 for session_config in SESSION_CONFIGS_DICT.values():
     app_name = session_config['name']
@@ -0,0 +1,145 @@
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+import json
+import threading
+
+from otree_redwood import scheduler, stats
+
+
+_subscribers = Counter()
+_session_codes = {}
+_pending = defaultdict(list)
+_lock = threading.Lock()
+_flush_timer = None
+
+
+def batch_interval():
+    """Seconds over which Events are coalesced into a single frame for watchers.
+    Set ``REDWOOD_WATCHER_BATCH_INTERVAL`` in settings.py to turn on coalescing;
+    a coalesced frame is a JSON list of Event messages. The default of 0 sends
+    one frame per Event.
+    """
+    return getattr(settings, 'REDWOOD_WATCHER_BATCH_INTERVAL', 0)
+
+
+def group_name(session_code):
+    return 'redwood_events-{}'.format(session_code)
+
+
+def subscriber_counts():
+    """Where the number of watchers of each session is kept, so that Events are only
+    published for watched sessions: ``'local'`` when the in-memory channel layer
+    means every socket is served by this process, ``'cache'`` when the default Django
+    cache is shared between processes, and None otherwise, in which case every
+    Event is published.
+    """
+    if isinstance(get_channel_layer(), InMemoryChannelLayer):
+        return 'local'
+    if not isinstance(caches['default'], (LocMemCache, DummyCache)):
+        return 'cache'
+    return None
+
+
+def _cache_key(session_code):
+    return 'redwood-watchers-{}'.format(session_code)
+
+
+def subscribe(session_code):
+    """Called when an EventWatcher connects to the given session."""
+    with _lock:
+        _subscribers[session_code] += 1
+    if subscriber_counts() == 'cache':
+        cache = caches['default']
+        cache.add(_cache_key(session_code), 0, timeout=None)
+        cache.incr(_cache_key(session_code))
+
+
+def unsubscribe(session_code):
+    """Called when an EventWatcher disconnects from the given session."""
+    with _lock:
+        _subscribers[session_code] -= 1
+        if _subscribers[session_code] <= 0:
+            del _subscribers[session_code]
+    if subscriber_counts() == 'cache':
+        try:
+            caches['default'].decr(_cache_key(session_code))
+        except ValueError:
+            pass
+
+
+def watched(session_codes):
+    """Returns the given session codes that have a watcher in any process."""
+    counts = subscriber_counts()
+    if counts == 'local':
+        return {code for code in session_codes if code in _subscribers}
+    if counts == 'cache':
+        found = caches['default'].get_many([_cache_key(code) for code in session_codes])
+        return {code for code in session_codes if found.get(_cache_key(code), 0) > 0}
+    return set(session_codes)
+
+
+def session_code(content_type_id, group_pk):
+    """Returns the code of the session the given group belongs to, cached per group."""
+    key = (content_type_id, group_pk)
+    code = _session_codes.get(key)
+    if code is None:
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        code = model.objects.filter(pk=group_pk).values_list('session__code', flat=True)[0]
+        _session_codes[key] = code
+    return code
+
+
+def notify(events):
+    """Forward saved Events to the EventWatchers of their session. Does nothing
+    for sessions nobody watches; see :func:`subscriber_counts`.
+    """
+    global _flush_timer
+    if subscriber_counts() == 'local' and not _subscribers:
+        return
+    by_session = defaultdict(list)
+    for event in events:
+        by_session[session_code(event.content_type_id, event.group_pk)].append(event)
+    frames = defaultdict(list)
+    for code in watched(list(by_session)):
+        frames[code] = [event.message for event in by_session[code]]
+    if not frames:
+        return
+    if not batch_interval():
+        for code, messages in frames.items():
+            for message in messages:
+                _send(code, json.dumps(message))
+        return
+    with _lock:
+        for code, messages in frames.items():
+            _pending[code].extend(messages)
+        if _flush_timer is None:
+            _flush_timer = scheduler.schedule(batch_interval(), flush)
+
+
+def flush():
+    """Send every coalesced frame that is waiting."""
+    global _flush_timer
+    with _lock:
+        _flush_timer = None
+        frames = dict(_pending)
+        _pending.clear()
+    for code, messages in frames.items():
+        _send(code, json.dumps(messages))
+
+
+def _send(session_code, text):
+    with stats.track('send to watchers'):
+        channel_layer = get_channel_layer()
+        async_to_sync(channel_layer.group_send)(
+            group_name(session_code),
+            {
+                'type': 'redwood.send_to_watcher',
+                'text': text
+            }
+        )
@@ -0,0 +1,132 @@
+from django.conf import settings
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def compression_threshold():
+    """Encoded size in bytes above which ``redwood.json+deflate`` compresses a frame.
+    Set with ``REDWOOD_COMPRESSION_THRESHOLD`` in settings.py.
+    """
+    return getattr(settings, 'REDWOOD_COMPRESSION_THRESHOLD', 1024)
+
+
+def dumps(content):
+    """Encode content as JSON text, using orjson if it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(content).decode('utf-8')
+        except TypeError:
+            # orjson is stricter than json, e.g. about non-string dict keys.
+            pass
+    return json.dumps(content)
+
+
+def loads(data):
+    """Decode JSON text or UTF-8 bytes, using orjson if it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class JsonCodec():
+    """JSON text frames."""
+
+    subprotocol = 'redwood.json'
+
+    def encode(self, content):
+        return dumps(content)
+
+    def decode(self, data):
+        return loads(data)
+
+
+class DeflateJsonCodec(JsonCodec):
+    """JSON text frames, with frames larger than :func:`compression_threshold`
+    sent as zlib-compressed binary frames instead.
+    """
+
+    subprotocol = 'redwood.json+deflate'
+
+    def __init__(self, threshold=None):
+        self.threshold = threshold
+
+    def encode(self, content):
+        text = dumps(content)
+        if self.threshold is None:
+            self.threshold = compression_threshold()
+        if len(text) <= self.threshold:
+            return text
+        return zlib.compress(text.encode('utf-8'))
+
+    def decode(self, data):
+        if isinstance(data, bytes):
+            data = zlib.decompress(data)
+        return loads(data)
+
+
+class MsgpackCodec():
+    """MessagePack binary frames. Requires the msgpack package."""
+
+    subprotocol = 'redwood.msgpack'
+
+    def encode(self, content):
+        return msgpack.packb(content, use_bin_type=True)
+
+    def decode(self, data):
+        if isinstance(data, str):
+            return loads(data)
+        return msgpack.unpackb(data, raw=False)
+
+
+DEFAULT = JsonCodec()
+
+
+def codecs():
+    """Returns the available codecs keyed by subprotocol."""
+    available = [DEFAULT, DeflateJsonCodec()]
+    if msgpack is not None:
+        available.append(MsgpackCodec())
+    return {codec.subprotocol: codec for codec in available}
+
+
+def negotiate(subprotocols):
+    """Returns the codec for the first of the client's subprotocols that is
+    available, and the subprotocol to accept (None if the client offered none).
+    Clients list subprotocols in order of preference, ending with ``redwood.json``.
+    """
+    available = codecs()
+    for subprotocol in subprotocols:
+        if subprotocol in available:
+            return available[subprotocol], subprotocol
+    return DEFAULT, None
+
+
+class CodecMixin():
+    """Encodes and decodes a consumer's frames with the codec negotiated on connect."""
+
+    codec = DEFAULT
+
+    def negotiate_codec(self):
+        """Picks the connection's codec; returns the subprotocol to pass to ``accept``."""
+        self.codec, subprotocol = negotiate(self.scope.get('subprotocols', []))
+        return subprotocol
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        return self.codec.decode(text_data if text_data is not None else bytes_data)
+
+    def encode_frame(self, content):
+        """Returns the keyword arguments for ``send`` carrying the encoded content."""
+        frame = self.codec.encode(content)
+        if isinstance(frame, bytes):
+            return {'bytes_data': frame}
+        return {'text_data': frame}
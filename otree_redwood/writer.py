@@ -0,0 +1,67 @@
+from django.conf import settings
+from django.utils import timezone
+import threading
+
+from otree_redwood import scheduler, stats, watchers
+
+
+_pending = []
+_lock = threading.Lock()
+_flush_timer = None
+
+
+def batch_size():
+    """Number of Events collected before they are written with a single
+    ``bulk_create``. Set ``REDWOOD_EVENT_BATCH_SIZE`` in settings.py to turn on
+    batching; the default of 1 writes every Event as soon as it is created.
+    """
+    return getattr(settings, 'REDWOOD_EVENT_BATCH_SIZE', 1)
+
+
+def batch_interval():
+    """Maximum number of seconds an Event waits in the batch before it is
+    written. Set with ``REDWOOD_EVENT_BATCH_INTERVAL`` in settings.py.
+    """
+    return getattr(settings, 'REDWOOD_EVENT_BATCH_INTERVAL', 0.1)
+
+
+def write(event, immediate=False):
+    """Queue an unsaved Event to be written to the database.
+
+    The Event is written immediately if batching is off or ``immediate`` is set,
+    otherwise once the batch is full or :func:`batch_interval` has passed.
+    """
+    global _flush_timer
+    if event.timestamp is None:
+        event.timestamp = timezone.now()
+    if batch_size() <= 1:
+        with stats.track('create event'):
+            event.save()
+        stats.increment('events written')
+        watchers.notify([event])
+        return
+    with _lock:
+        _pending.append(event)
+        full = len(_pending) >= batch_size()
+        if not full and not immediate and _flush_timer is None:
+            _flush_timer = scheduler.schedule(batch_interval(), flush)
+    if full or immediate:
+        flush()
+
+
+def flush():
+    """Write every queued Event to the database and notify watchers."""
+    global _flush_timer
+    with _lock:
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+        events = _pending[:]
+        del _pending[:]
+    if not events:
+        return
+    with stats.track('bulk create events'):
+        events[0].__class__.objects.bulk_create(events)
+    stats.increment('events written', len(events))
+    watchers.notify(events)
+
@@ -71,6 +71,12 @@ class RedwoodDecision extends PolymerElement {
                 type: Number,
                 value: 0
             },
+            /* Version of the last `group_decisions` message applied, or null
+             * while waiting for a full snapshot after a missed delta. */
+            _version: {
+                type: Number,
+                value: null
+            },
             _queries: {
                 type: Array,
                 value: () => {
@@ -100,7 +106,19 @@ class RedwoodDecision extends PolymerElement {
     }
 
     _handleGroupDecisionsEvent(event) {
-        this.groupDecisions = event.detail.payload;
+        const msg = event.detail;
+        if (msg.delta) {
+            // Deltas only apply on top of the version just before them.
+            // After a gap, wait for the next full snapshot.
+            if (this._version === null || msg.version !== this._version + 1) {
+                this._version = null;
+                return;
+            }
+            this.groupDecisions = Object.assign({}, this.groupDecisions, msg.payload);
+        } else {
+            this.groupDecisions = msg.payload;
+        }
+        this._version = msg.version === undefined ? null : msg.version;
         const pcode = this.$.constants.participantCode;
         this.myCurrentDecision = this.groupDecisions[pcode];
         if (this.myDecision === null) {
@@ -4,6 +4,70 @@ import '../otree-constants/otree-constants.js';
 var socket = null;
 var listeners = [];
 
+/* Milliseconds between heartbeats. The server drops connections that haven't
+ * sent anything for REDWOOD_HEARTBEAT_TIMEOUT seconds (30 by default). */
+const HEARTBEAT_INTERVAL = 10000;
+
+/* WebSocket subprotocols in order of preference. The server picks the first
+ * one it supports; `redwood.json` must be last since it is always supported.
+ * MessagePack is offered if a MessagePack library (e.g. @msgpack/msgpack) is
+ * loaded as `window.MessagePack`. */
+function subprotocols() {
+    const protocols = [];
+    if (window.MessagePack) {
+        protocols.push('redwood.msgpack');
+    }
+    if (window.DecompressionStream) {
+        protocols.push('redwood.json+deflate');
+    }
+    protocols.push('redwood.json');
+    return protocols;
+}
+
+function encodeFrame(content) {
+    if (socket.protocol === 'redwood.msgpack') {
+        return window.MessagePack.encode(content);
+    }
+    return JSON.stringify(content);
+}
+
+function decodeFrame(data) {
+    if (typeof data === 'string') {
+        return Promise.resolve(JSON.parse(data));
+    }
+    if (socket.protocol === 'redwood.msgpack') {
+        return Promise.resolve(window.MessagePack.decode(new Uint8Array(data)));
+    }
+    // redwood.json+deflate sends large frames as zlib-compressed binary.
+    const stream = new Blob([data]).stream().pipeThrough(new DecompressionStream('deflate'));
+    return new Response(stream).text().then(JSON.parse);
+}
+
+/* Decompression is asynchronous; chaining keeps frames in order. */
+var decoding = Promise.resolve();
+
+/* Frames handled since the socket opened, acknowledged on the `ack` channel at
+ * least every ACK_EVERY frames or ACK_DELAY milliseconds. The server holds back
+ * group messages, coalescing them, while too many frames are unacknowledged
+ * (REDWOOD_OUTBOUND_WINDOW, which must be more than ACK_EVERY). */
+const ACK_EVERY = 8;
+const ACK_DELAY = 100;
+var received = 0;
+var acked = 0;
+var ackTimer = null;
+
+function sendAck() {
+    window.clearTimeout(ackTimer);
+    ackTimer = null;
+    if (socket.readyState == 1) {
+        socket.send(encodeFrame({
+            'channel': 'ack',
+            'payload': received,
+        }));
+        acked = received;
+    }
+}
+
 /*
 
 `<redwood-events>` is the lowest-level component. It maintains a single
@@ -93,13 +157,15 @@ class RedwoodEvents extends PolymerElement {
                 '/group/' + this.$.constants.group.pk +
                 '/participant/' + this.$.constants.participantCode +
                 '/');
-            socket = new ReconnectingWebSocket(addr, null, {
-                timeoutInterval: 10000
+            socket = new ReconnectingWebSocket(addr, subprotocols(), {
+                timeoutInterval: 10000,
+                binaryType: 'arraybuffer'
             });
             socket.onerror = this._onError.bind(this);
             socket.onopen = this._onOpen.bind(this);
             socket.onmessage = this._onMessage.bind(this);
             socket.onclose = this._onClose.bind(this);
+            window.setInterval(this._sendHeartbeat.bind(this), HEARTBEAT_INTERVAL);
         }
         this.socket = socket;
         this.pending = [];
@@ -113,10 +179,13 @@ class RedwoodEvents extends PolymerElement {
 
     _onOpen() {
         this.socket = socket;
+        received = 0;
+        sendAck();
         listeners.forEach(l => {
             l.pending.forEach(msg => {
-                socket.send(msg);
+                socket.send(encodeFrame(msg));
             });
+            l.pending = [];
         });
         if (this._debug) {
             this._sendPing();
@@ -134,7 +203,13 @@ class RedwoodEvents extends PolymerElement {
 
     _onMessage(message) {
         this.socket = socket;
-        const event = JSON.parse(message.data);
+        decoding = decoding
+            .then(() => decodeFrame(message.data))
+            .then(this._dispatch.bind(this))
+            .catch(err => console.error(err));
+    }
+
+    _dispatch(event) {
         if (event.channel == 'ping') {
             const rtt = Date.now() - event.timestamp;
             this.push('_roundTripTimes', rtt);
@@ -146,6 +221,12 @@ class RedwoodEvents extends PolymerElement {
         listeners.forEach(l => {
             l.dispatchEvent(new CustomEvent('event', { detail: event }));
         });
+        received++;
+        if (received - acked >= ACK_EVERY) {
+            sendAck();
+        } else if (ackTimer === null) {
+            ackTimer = window.setTimeout(sendAck, ACK_DELAY);
+        }
     }
 
     /**
@@ -161,7 +242,7 @@ class RedwoodEvents extends PolymerElement {
     _sendPing() {
         this.socket = socket;
         if (socket.readyState == 1) {
-            socket.send(JSON.stringify({
+            socket.send(encodeFrame({
                 'channel': 'ping',
                 'timestamp': Date.now(),
                 'avgping_time': this._avgPingTime,
@@ -172,6 +253,14 @@ class RedwoodEvents extends PolymerElement {
         }
     }
 
+    _sendHeartbeat() {
+        if (socket.readyState == 1) {
+            socket.send(encodeFrame({
+                'channel': 'heartbeat',
+            }));
+        }
+    }
+
     _computeAvgPingTime() {
         if (this._roundTripTimes.length == 0) {
             return NaN;
@@ -197,15 +286,15 @@ class RedwoodEvents extends PolymerElement {
      * @param {Object} value
      */
     send(channel, value) {
-        const msg = JSON.stringify({
+        const msg = {
             'channel': channel,
             'payload': value
-        });
+        };
         if (socket.readyState != 1) {
             this.pending.push(msg);
             return;
         }
-        socket.send(msg);
+        socket.send(encodeFrame(msg));
     }
 }
 
@@ -42,6 +42,10 @@ setup(
     ],
     install_requires=[
         'jsonfield>=2.0.2',
-        'mockredispy>=2.9.3',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+        'msgpack': ['msgpack'],
+        'orjson': ['orjson'],
+    },
 )
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('otree')
+
+# The tests directory is a small oTree project using otree_redwood from this checkout;
+# see settings.py.
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django
+from django.conf import settings
+
+if not settings.configured:
+    from otree_startup import configure_settings
+    configure_settings('settings')
+    django.setup()
+
+
+@pytest.fixture(scope='session', autouse=True)
+def test_database():
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+    setup_test_environment()
+    name = connection.creation.create_test_db(verbosity=0)
+    yield
+    connection.creation.destroy_test_db(name, verbosity=0)
+    teardown_test_environment()
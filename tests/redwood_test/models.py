@@ -0,0 +1,23 @@
+from otree.api import BaseConstants, BasePlayer, BaseSubsession
+
+from otree_redwood.models import DecisionGroup
+
+
+class Constants(BaseConstants):
+    name_in_url = 'redwood_test'
+    players_per_group = 2
+    num_rounds = 1
+
+
+class Subsession(BaseSubsession):
+    pass
+
+
+class Group(DecisionGroup):
+    pass
+
+
+class Player(BasePlayer):
+
+    def initial_decision(self):
+        return 0
@@ -0,0 +1,29 @@
+# oTree project used by the otree-redwood tests.
+
+SECRET_KEY = 'otree-redwood-tests'
+ADMIN_USERNAME = 'admin'
+LANGUAGE_CODE = 'en'
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+}
+
+SESSION_CONFIG_DEFAULTS = {
+    'real_world_currency_per_point': 1.00,
+    'participation_fee': 0.00,
+}
+
+SESSION_CONFIGS = [
+    {
+        'name': 'redwood_test',
+        'display_name': 'otree-redwood tests',
+        'num_demo_participants': 2,
+        'app_sequence': ['redwood_test'],
+    },
+]
+
+INSTALLED_APPS = ['otree']
+EXTENSION_APPS = ['otree_redwood']
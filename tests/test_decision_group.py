@@ -0,0 +1,130 @@
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+from otree.models import Participant, Session
+
+from otree_redwood import state as group_state
+from otree_redwood.models import Event
+from redwood_test.models import Group, Player, Subsession
+
+
+class DecisionGroupTestCase(TestCase):
+    """Runs a DecisionGroup of two players without sockets or timers: decisions are
+    handed to ``_on_decisions_event`` as the consumer would, ticks are called directly,
+    and broadcasts are captured instead of sent on the channel layer.
+    """
+
+    def setUp(self):
+        session = Session.objects.create(config={'name': 'redwood_test'})
+        subsession = Subsession.objects.create(session=session, round_number=1)
+        self.group = Group.objects.create(session=session, subsession=subsession, round_number=1, id_in_subsession=1)
+        self.players = []
+        for i in [1, 2]:
+            participant = Participant.objects.create(session=session, id_in_session=i, _max_page_index=1)
+            self.players.append(Player.objects.create(
+                session=session, subsession=subsession, group=self.group,
+                participant=participant, id_in_group=i, round_number=1))
+        broadcast = mock.patch.object(Group, '_broadcast', autospec=True)
+        self.broadcast = broadcast.start()
+        self.addCleanup(broadcast.stop)
+
+    def tearDown(self):
+        group_state.discard(self.group)
+
+    def start(self, **hooks):
+        """Overrides the group's hooks with the given return values and runs
+        ``when_all_players_ready`` as ``_on_connect`` does, without starting timers.
+        """
+        for name, value in hooks.items():
+            setattr(self.group, name, lambda value=value: value)
+        with mock.patch('otree_redwood.models.DiscreteEventEmitter.start'):
+            self.group.when_all_players_ready()
+        self.group.ran_ready_function = timezone.now()
+        self.group.save()
+
+    def decide(self, player, value):
+        event = Event.objects.create(group=self.group, participant=player.participant, channel='decisions', value=value)
+        self.group._on_decisions_event(event)
+
+    def saved(self, field):
+        group_state.get(self.group).flush()
+        return getattr(Group.objects.get(pk=self.group.pk), field)
+
+    def broadcasts(self):
+        return [call[0][2] for call in self.broadcast.call_args_list if call[0][1] == 'group_decisions']
+
+    def decisions(self, *values):
+        return {player.participant.code: value for player, value in zip(self.players, values)}
+
+
+class DecisionsTest(DecisionGroupTestCase):
+
+    def test_default(self):
+        self.start()
+        self.decide(self.players[0], 1)
+        self.assertEqual(self.broadcasts(), [self.decisions(1, 0)])
+        self.assertEqual(self.saved('group_decisions'), self.decisions(1, 0))
+
+    def test_state_flush_interval(self):
+        self.start(state_flush_interval=10)
+        self.decide(self.players[0], 1)
+        self.assertEqual(self.broadcasts(), [self.decisions(1, 0)])
+        self.assertEqual(Group.objects.get(pk=self.group.pk).group_decisions, self.decisions(0, 0))
+        self.assertEqual(self.saved('group_decisions'), self.decisions(1, 0))
+
+    def test_rate_limit(self):
+        self.start(rate_limit=10, period_length=60)
+        self.decide(self.players[0], 1)
+        self.assertEqual(self.broadcasts(), [])
+        self.assertEqual(self.saved('group_decisions'), self.decisions(1, 0))
+
+    def test_rate_limit_broadcasts_once_per_window(self):
+        self.start(rate_limit=10, period_length=60)
+        self.decide(self.players[0], 1)
+        self.decide(self.players[1], 2)
+        self.group._rate_limit_tick(0, 6)
+        self.assertEqual(self.broadcasts(), [self.decisions(1, 2)])
+        with self.assertNumQueries(0):
+            self.group._rate_limit_tick(1, 6)
+        self.assertEqual(len(self.broadcasts()), 1)
+
+    def test_rate_limit_tick_after_period_end(self):
+        self.start(rate_limit=10, period_length=60)
+        self.decide(self.players[0], 1)
+        self.group._on_period_end()
+        self.assertEqual(self.broadcasts(), [self.decisions(1, 0)])
+        self.group._rate_limit_tick(6, 6)
+        self.assertEqual(len(self.broadcasts()), 1)
+        self.assertNotIn(group_state._key(self.group), group_state._states)
+
+    def test_num_subperiods(self):
+        self.start(num_subperiods=4, period_length=4)
+        self.decide(self.players[0], 1)
+        self.assertEqual(self.broadcasts(), [])
+        self.group._subperiod_tick(0, 4)
+        self.assertEqual(self.broadcasts(), [self.decisions(1, 0)])
+        self.assertEqual(self.saved('subperiod_group_decisions'), self.decisions(1, 0))
+
+    def test_num_subperiods_with_state_flush_interval(self):
+        self.start(num_subperiods=4, period_length=4, state_flush_interval=10)
+        self.decide(self.players[0], 1)
+        self.decide(self.players[1], 2)
+        self.group._subperiod_tick(0, 4)
+        self.assertEqual(self.broadcasts(), [self.decisions(1, 2)])
+        self.assertEqual(self.saved('subperiod_group_decisions'), self.decisions(1, 2))
+
+    def test_delta_subperiod_tick_after_period_end(self):
+        self.start(num_subperiods=4, period_length=4, delta_broadcasts=10)
+        self.decide(self.players[0], 1)
+        self.group._on_period_end()
+        self.group._subperiod_tick(3, 4)
+        self.assertEqual(self.broadcasts(), [self.decisions(1, 0)])
+        self.assertNotIn(group_state._key(self.group), group_state._states)
+
+    def test_decision_after_period_end_is_ignored(self):
+        self.start(state_flush_interval=10)
+        self.group._on_period_end()
+        self.decide(self.players[0], 1)
+        self.assertEqual(self.broadcasts(), [])
+        self.assertNotIn(group_state._key(self.group), group_state._states)
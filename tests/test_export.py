@@ -0,0 +1,32 @@
+import datetime
+
+from django.test import TestCase
+from django.utils import timezone
+from otree.models import Session
+
+from otree_redwood import export
+from otree_redwood.models import Event
+from redwood_test.models import Group, Subsession
+
+
+class LastEventTest(TestCase):
+
+    def setUp(self):
+        session = Session.objects.create(config={'name': 'redwood_test'})
+        subsession = Subsession.objects.create(session=session, round_number=1)
+        self.group = Group.objects.create(session=session, subsession=subsession, round_number=1, id_in_subsession=1)
+
+    def event(self, age):
+        return Event.objects.create(
+            group=self.group, channel='state', value=None,
+            timestamp=timezone.now() - datetime.timedelta(seconds=age))
+
+    def test_lags_behind_events_that_may_not_be_visible_yet(self):
+        settled = self.event(60)
+        self.event(0)
+        latest = export.last_event(Group.objects.all())
+        self.assertEqual(latest, {'id': settled.id, 'timestamp': settled.timestamp})
+
+    def test_none_before_any_event_has_settled(self):
+        self.event(0)
+        self.assertEqual(export.last_event(Group.objects.all()), {'id': None, 'timestamp': None})
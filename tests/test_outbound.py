@@ -0,0 +1,68 @@
+from django.test import SimpleTestCase, override_settings
+
+from otree_redwood.consumers import EventConsumer, OutboundQueue
+
+
+class OutboundQueueTest(SimpleTestCase):
+
+    def test_snapshot_replaces_queued_messages_in_place(self):
+        queue = OutboundQueue(8, {'group_decisions'})
+        queue.put({'channel': 'group_decisions', 'payload': {'a': 1}})
+        queue.put({'channel': 'state', 'payload': 'period_end'})
+        queue.put({'channel': 'group_decisions', 'payload': {'a': 2}})
+        self.assertEqual(list(queue.messages), [
+            {'channel': 'group_decisions', 'payload': {'a': 2}},
+            {'channel': 'state', 'payload': 'period_end'},
+        ])
+
+    def test_delta_merges_into_queued_snapshot(self):
+        queue = OutboundQueue(8, {'group_decisions'})
+        snapshot = {'channel': 'group_decisions', 'payload': {'a': 1, 'b': 1}, 'version': 1}
+        queue.put(snapshot)
+        queue.put({'channel': 'group_decisions', 'payload': {'b': 2}, 'version': 2, 'delta': True})
+        self.assertEqual(list(queue.messages), [
+            {'channel': 'group_decisions', 'payload': {'a': 1, 'b': 2}, 'version': 2},
+        ])
+        self.assertEqual(snapshot['payload'], {'a': 1, 'b': 1})
+
+    def test_full_queue_drops_oldest_message_not_on_state(self):
+        queue = OutboundQueue(2, set())
+        queue.put({'channel': 'state', 'payload': 'period_start'})
+        queue.put({'channel': 'chat', 'payload': 1})
+        queue.put({'channel': 'chat', 'payload': 2})
+        self.assertEqual([m['payload'] for m in queue.messages], ['period_start', 2])
+
+
+class FakeConsumer(EventConsumer):
+
+    def __init__(self):
+        self.sent = []
+        self.open_outbound()
+
+    def send(self, **frame):
+        self.sent.append(frame)
+
+
+@override_settings(REDWOOD_OUTBOUND_WINDOW=2)
+class OutboundWindowTest(SimpleTestCase):
+
+    def group_message(self, consumer, channel, payload):
+        consumer.redwood_send_to_group({'text': {'channel': channel, 'payload': payload}})
+
+    def test_clients_that_never_acknowledge_get_every_message(self):
+        consumer = FakeConsumer()
+        for i in range(5):
+            self.group_message(consumer, 'chat', i)
+        self.assertEqual(len(consumer.sent), 5)
+
+    def test_unacknowledged_frames_hold_back_and_coalesce_group_messages(self):
+        consumer = FakeConsumer()
+        consumer.receive_json({'channel': 'ack', 'payload': 0})
+        for i in range(5):
+            self.group_message(consumer, 'group_decisions', {'a': i})
+        self.assertEqual(len(consumer.sent), 2)
+        self.assertEqual(list(consumer.outbound.messages), [{'channel': 'group_decisions', 'payload': {'a': 4}}])
+
+        consumer.receive_json({'channel': 'ack', 'payload': 2})
+        self.assertEqual(len(consumer.sent), 3)
+        self.assertEqual(len(consumer.outbound), 0)
@@ -0,0 +1,26 @@
+from otree_redwood import presence
+
+from test_decision_group import DecisionGroupTestCase
+
+
+class PresenceTest(DecisionGroupTestCase):
+
+    def participants(self):
+        return [player.participant for player in self.players]
+
+    def test_registry_entry_is_dropped_when_the_last_participant_disconnects(self):
+        for participant in self.participants():
+            presence.connect(self.group, participant)
+        self.assertTrue(presence.all_connected(self.group))
+        presence.disconnect(self.group, self.participants()[0])
+        self.assertIn(presence._key(self.group), presence._registry)
+        presence.disconnect(self.group, self.participants()[1])
+        self.assertNotIn(presence._key(self.group), presence._registry)
+
+    def test_heartbeat_after_discard_does_not_recreate_the_entry(self):
+        presence.connect(self.group, self.participants()[0])
+        presence.discard(self.group)
+        presence.heartbeat(self.group, self.participants()[0])
+        presence.disconnect(self.group, self.participants()[0])
+        self.assertNotIn(presence._key(self.group), presence._registry)
+        self.assertFalse(presence._connections(self.group).exists())